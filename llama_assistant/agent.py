@@ -1,16 +1,52 @@
-from typing import List, Set, Optional, Dict, TYPE_CHECKING
-
-from llama_cpp import Llama
-from llama_index.core import VectorStoreIndex
+import asyncio
+import queue
+import time
+import weakref
+from contextlib import nullcontext
+from threading import Event as ThreadingEvent, Lock, Thread, Timer
+from typing import Callable, List, Set, Optional, Dict, Tuple, TYPE_CHECKING
+
+from llama_cpp import Llama, StoppingCriteriaList
+from llama_index.core import StorageContext, VectorStoreIndex
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.core.schema import NodeWithScore
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, Settings
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore
+from llama_index.core import VectorStoreIndex
+from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.workflow import Context
 from llama_index.core.postprocessor import SimilarityPostprocessor
 
 from llama_index.core.workflow import Event, StartEvent, StopEvent, Workflow, step
 
+from llama_assistant.bm25_index import BM25Index
+from llama_assistant.context_packer import ContextPacker
+from llama_assistant.document_parser import parse_files
+from llama_assistant.embedding_cache import get_embedding_cache
+from llama_assistant.index_store import index_store
+from llama_assistant.reranker import get_reranker, preload_reranker
+from llama_assistant.vector_store import LocalVectorStore
+
 SYSTEM_PROMPT = {"role": "system", "content": "Generate short and simple response."}
+EMBED_MODEL_IDLE_SECONDS = 600
+
+# words that refer back to the conversation, a query containing them is not stand-alone
+REFERRING_WORDS = set(
+    "it its this that these those they them their he him his she her above previous earlier "
+    "former latter same again more else other another one ones".split()
+)
+# shorter queries are usually follow-ups ("and in python?") and are always condensed
+MIN_STANDALONE_QUERY_WORDS = 5
+# the chat history is summarized in the background once it fills this share of its budget
+SUMMARY_WATERMARK = 0.75
+# share of the input tokens the chat history may use, the rest is left for documents and query
+HISTORY_SHARE = 0.75
+# role markers and separators the chat template adds around every message
+MESSAGE_OVERHEAD_TOKENS = 8
+# below this many free tokens no document context is added to the query
+MIN_CONTEXT_TOKENS = 128
+# rank constant of reciprocal rank fusion of the dense and the keyword results
+RRF_K = 60
+# keyword matches scoring below this share of the best one are dropped
+BM25_MIN_RELATIVE_SCORE = 0.5
 
 
 def convert_message_list_to_str(messages):
@@ -34,114 +70,326 @@ class CondenseQueryEvent(Event):
 
 class RetrievalEvent(Event):
     nodes: List[NodeWithScore]
+    query_str: str = ""
+
+
+class RerankEvent(Event):
+    nodes: List[NodeWithScore]
+
+
+class ProgressEvent(Event):
+    """Streamed to the caller while the workflow runs. loading is False once the response
+    has started and no loading indicator should be shown anymore."""
+
+    message: str
+    loading: bool = True
+
+
+class TokenEvent(Event):
+    """A streamed chat completion chunk"""
+
+    chunk: Dict
+
+
+class EmbeddingPipeline:
+    """
+    Embed chunks in fixed-size batches on a background thread.
+
+    Callers submit the chunks of one document at a time, so chunking (and tokenizing) the next
+    document overlaps with model inference on the previous one. Each batch is looked up in the
+    embedding cache first and only the misses are sent to the embed model.
+    """
+
+    def __init__(self, embed_model, embedding_cache, batch_size: int, max_pending_batches: int = 4):
+        self.embed_model = embed_model
+        self.embedding_cache = embedding_cache
+        self.batch_size = batch_size
+        self.batches = queue.Queue(maxsize=max_pending_batches)
+        self.error: Optional[Exception] = None
+        self.num_chunks = 0
+        self.num_embedded = 0
+        self.embed_time = 0.0
+        self.start_time = time.time()
+        self.worker = Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, nodes: List[BaseNode], on_done: Callable[[List[BaseNode]], None]):
+        """Queue nodes for embedding, on_done is called with the nodes once all are embedded"""
+        if not nodes:
+            on_done(nodes)
+            return
+
+        group = {"nodes": nodes, "remaining": len(nodes), "on_done": on_done}
+        for start in range(0, len(nodes), self.batch_size):
+            self.batches.put((group, nodes[start : start + self.batch_size]))
+
+    def _run(self):
+        while True:
+            item = self.batches.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+
+            group, batch = item
+            try:
+                self._embed_batch(batch)
+                group["remaining"] -= len(batch)
+                if group["remaining"] == 0:
+                    group["on_done"](group["nodes"])
+            except Exception as e:
+                self.error = e
+
+    def _embed_batch(self, batch: List[BaseNode]):
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+        embeddings = self.embedding_cache.get_many(texts)
+
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            missing_texts = [texts[idx] for idx in missing]
+            start_time = time.time()
+            new_embeddings = self.embed_model.get_text_embedding_batch(missing_texts)
+            self.embed_time += time.time() - start_time
+            self.embedding_cache.put_many(missing_texts, new_embeddings)
+            for idx, embedding in zip(missing, new_embeddings):
+                embeddings[idx] = embedding
+
+        for node, embedding in zip(batch, embeddings):
+            node.embedding = embedding
+
+        self.num_chunks += len(batch)
+        self.num_embedded += len(missing)
+
+    def join(self):
+        """Wait until every submitted chunk is embedded and report throughput"""
+        self.batches.put(None)
+        self.worker.join()
+        # once per run, rewriting the cache index after every batch makes large ingests slow
+        self.embedding_cache.flush()
+        if self.error is not None:
+            raise self.error
+
+        print(
+            f"Embedded {self.num_embedded}/{self.num_chunks} chunks "
+            f"({self.num_chunks - self.num_embedded} from cache) "
+            f"in {time.time() - self.start_time:.2f}s, "
+            f"model throughput: {self.throughput:.1f} chunks/s"
+        )
+
+    @property
+    def throughput(self) -> float:
+        """Chunks per second spent in the embed model, excluding cache hits"""
+        if self.embed_time == 0:
+            return 0.0
+        return self.num_embedded / self.embed_time
+
+
+class SharedEmbedModel:
+    """
+    Process-wide embed model shared by all agents. It is only loaded when documents are indexed
+    and the shared reference is dropped after EMBED_MODEL_IDLE_SECONDS without indexing, so it
+    is freed as soon as no search index uses it anymore.
+    """
+
+    def __init__(self):
+        self.embed_model: Optional[HuggingFaceEmbedding] = None
+        # the last released model, reused if a search index still keeps it alive
+        self.released_model: Optional[weakref.ref] = None
+        self.lock = Lock()
+        self.release_timer: Optional[Timer] = None
+
+    def get(self, model_name: str, embed_batch_size: int) -> HuggingFaceEmbedding:
+        with self.lock:
+            embed_model = self.embed_model
+            if embed_model is None and self.released_model is not None:
+                embed_model = self.released_model()
+
+            if embed_model is None or embed_model.model_name != model_name:
+                print(f"Loading embedding model {model_name}...")
+                embed_model = HuggingFaceEmbedding(
+                    model_name=model_name, embed_batch_size=embed_batch_size
+                )
+            embed_model.embed_batch_size = embed_batch_size
+
+            self.embed_model = embed_model
+            self.released_model = None
+            self._schedule_release()
+            return embed_model
+
+    def release(self):
+        with self.lock:
+            if self.embed_model is not None:
+                print(f"Releasing idle embedding model {self.embed_model.model_name}")
+                self.released_model = weakref.ref(self.embed_model)
+                self.embed_model = None
+
+    def _schedule_release(self):
+        if self.release_timer:
+            self.release_timer.cancel()
+
+        self.release_timer = Timer(EMBED_MODEL_IDLE_SECONDS, self.release)
+        self.release_timer.daemon = True
+        self.release_timer.start()
+
+
+shared_embed_model = SharedEmbedModel()
 
 
 class ChatHistory:
-    def __init__(self, llm, max_history_size: int, max_output_tokens: int):
+    def __init__(
+        self,
+        llm,
+        max_history_size: int,
+        max_output_tokens: int,
+        llm_lock: Optional[Lock] = None,
+    ):
         self.llm = llm
+        self.llm_lock = llm_lock or Lock()
         self.max_output_tokens = max_output_tokens
-        self.max_history_size = max_history_size  # in tokens
-        self.max_history_size_in_words = max_history_size * 3 / 4
-        self.max_history_size_in_words = (
-            self.max_history_size_in_words - 128
-        )  # to account for some formatting tokens
-        print("Max history size in words:", self.max_history_size_in_words)
-        self.total_size = 0
+        self.set_max_history_size(max_history_size)
+        self.total_size = 0  # in tokens
         self.chat_history = []
+        # token count of each message in chat_history, computed once when it is added
+        self.message_sizes: List[int] = []
+        self.lock = Lock()
+        self.summary_thread: Optional[Thread] = None
+
+    def set_max_history_size(self, max_history_size: int):
+        """max_history_size is the input token budget, the history may use HISTORY_SHARE of it"""
+        self.max_history_size = max_history_size
+        self.max_history_tokens = int(max_history_size * HISTORY_SHARE)
+        print("Max history size in tokens:", self.max_history_tokens)
+
+    def count_tokens(self, text: str) -> int:
+        # tokenizing only reads the vocabulary, it does not need the llm lock
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
 
     def _get_message_size(self, message: dict) -> int:
-        """Calculate the size of a message in words"""
+        """Calculate the size of a message in tokens"""
         if "content" in message and type(message["content"]) is list:
             # multimodal model's message format
-            return len(message["content"][0]["text"].split())
+            text = message["content"][0]["text"]
         else:
             # text-only model's message format
-            return len(message["content"].split())
+            text = message["content"]
+        return self.count_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+
+    def _set_history(self, messages: List[dict], message_sizes: List[int]):
+        self.chat_history = messages
+        self.message_sizes = message_sizes
+        self.total_size = sum(message_sizes)
 
     def add_conversation_turn(self, user_message: dict, assistant_message: dict):
         """Add a complete conversation turn (user + assistant) to history"""
-        user_msg_size = self._get_message_size(user_message)
-        assistant_msg_size = self._get_message_size(assistant_message)
-        total_new_size = user_msg_size + assistant_msg_size
+        new_sizes = [
+            self._get_message_size(user_message),
+            self._get_message_size(assistant_message),
+        ]
+        with self.lock:
+            self.chat_history.extend([user_message, assistant_message])
+            self.message_sizes.extend(new_sizes)
+            self.total_size += sum(new_sizes)
 
-        if self.total_size + total_new_size > self.max_history_size_in_words:
-            print("Chat history is too long, summarizing the conversation...")
-            history_summary = self.llm.create_chat_completion(
-                messages=[SYSTEM_PROMPT]
-                + self.chat_history
-                + [
-                    {
-                        "role": "user",
-                        "content": "Briefly summarize the conversation in a few sentences.",
-                    }
-                ],
-                stream=False,
-                max_tokens=256,
-            )["choices"][0]["message"]["content"]
+        print("\nChat history token count:", self.total_size)
 
-            # new history with the summary and the new conversation turn
-            # Summary is treated as if the assistant said it, followed by the new user message and response
-            self.chat_history = [
+    def add_message(self, message: dict):
+        """Add a single message to history (for backward compatibility)"""
+        new_size = self._get_message_size(message)
+        with self.lock:
+            self.chat_history.append(message)
+            self.message_sizes.append(new_size)
+            self.total_size += new_size
+
+        print("\nChat history token count:", self.total_size)
+
+    def summarize_if_needed(self):
+        """Summarize the history in the background once it fills SUMMARY_WATERMARK of its budget,
+        so that it fits again before the next turns without delaying the current one"""
+        with self.lock:
+            if self.total_size <= self.max_history_tokens * SUMMARY_WATERMARK:
+                return
+            if self.is_summarizing():
+                return
+
+            # only summarize complete turns so that the roles keep alternating
+            num_messages = len(self.chat_history)
+            if num_messages > 0 and self.chat_history[-1]["role"] == "user":
+                num_messages -= 1
+            if num_messages < 2:
+                return
+
+            self.summary_thread = Thread(
+                target=self._summarize, args=(self.chat_history[:num_messages],), daemon=True
+            )
+            self.summary_thread.start()
+
+    def _summarize(self, messages: List[dict]):
+        print("Chat history is getting long, summarizing the conversation in the background...")
+        start_time = time.time()
+        try:
+            with self.llm_lock:
+                history_summary = self.llm.create_chat_completion(
+                    messages=[SYSTEM_PROMPT]
+                    + messages
+                    + [
+                        {
+                            "role": "user",
+                            "content": "Briefly summarize the conversation in a few sentences.",
+                        }
+                    ],
+                    stream=False,
+                    max_tokens=256,
+                )["choices"][0]["message"]["content"]
+        except Exception as e:
+            print(f"Failed to summarize the chat history: {e}")
+            return
+
+        with self.lock:
+            if len(self.chat_history) < len(messages) or any(
+                current is not summarized
+                for current, summarized in zip(self.chat_history, messages)
+            ):
+                # the history was cleared or replaced in the meantime
+                return
+
+            # new history with the summary and the turns added while summarizing
+            # Summary is treated as if the assistant said it
+            summary_messages = [
                 {"role": "user", "content": "Please summarize our conversation so far."},
                 {"role": "assistant", "content": history_summary},
-                user_message,
-                assistant_message,
             ]
+            self._set_history(
+                summary_messages + self.chat_history[len(messages) :],
+                [self._get_message_size(message) for message in summary_messages]
+                + self.message_sizes[len(messages) :],
+            )
 
-            self.total_size = (
-                len(history_summary.split()) + total_new_size + 10
-            )  # +10 for summary prompt
-        else:
-            self.chat_history.append(user_message)
-            self.chat_history.append(assistant_message)
-            self.total_size += total_new_size
-
-        print("\nChat history word count:", self.total_size)
-
-    def add_message(self, message: dict):
-        """Add a single message to history (for backward compatibility)"""
-        new_msg_size = self._get_message_size(message)
-
-        if self.total_size + new_msg_size > self.max_history_size_in_words:
-            print("Chat history is too long, summarizing the conversation...")
-            history_summary = self.llm.create_chat_completion(
-                messages=[SYSTEM_PROMPT]
-                + self.chat_history
-                + [
-                    {
-                        "role": "user",
-                        "content": "Briefly summarize the conversation in a few sentences.",
-                    }
-                ],
-                stream=False,
-                max_tokens=256,
-            )["choices"][0]["message"]["content"]
+        print(
+            f"Summarized the chat history in {time.time() - start_time:.2f}s, "
+            f"token count: {self.total_size}"
+        )
 
-            # new history with the summary of the conversation and the last message
-            # Ensure proper role alternation
-            if message["role"] == "user":
-                self.chat_history = [
-                    {"role": "user", "content": "Please summarize our conversation so far."},
-                    {"role": "assistant", "content": history_summary},
-                    message,
-                ]
-            else:
-                # If adding assistant message, we need a user message before it
-                self.chat_history = [{"role": "assistant", "content": history_summary}, message]
-
-            self.total_size = len(history_summary.split()) + new_msg_size + 10
-        else:
-            self.chat_history.append(message)
-            self.total_size += new_msg_size
+    def is_summarizing(self) -> bool:
+        return self.summary_thread is not None and self.summary_thread.is_alive()
 
-        print("\nChat history word count:", self.total_size)
+    def wait_for_summary(self):
+        """Block until a running summarization has replaced the history"""
+        summary_thread = self.summary_thread
+        if summary_thread is not None:
+            summary_thread.join()
 
     def get_chat_history(self):
         return self.chat_history
 
+    def load(self, messages: List[dict]):
+        """Replace the history, e.g. with one restored from a saved session"""
+        message_sizes = [self._get_message_size(message) for message in messages]
+        with self.lock:
+            self._set_history(list(messages), message_sizes)
+
     def clear(self):
-        self.chat_history = []
-        self.total_size = 0
+        with self.lock:
+            self._set_history([], [])
 
     def __len__(self):
         return len(self.chat_history)
@@ -168,54 +416,170 @@ class RAGAgent(Workflow):
         generation_setting: Dict,
         rag_setting: Dict,
         llm: Llama,
-        timeout: int = 60,
+        # responses are streamed from inside the workflow, a long answer must not time it out
+        timeout: Optional[float] = None,
         verbose: bool = False,
     ):
         super().__init__(timeout=timeout, verbose=verbose)
         self.generation_setting = generation_setting
         self.context_len = generation_setting["context_len"]
         self.max_output_tokens = generation_setting["max_output_tokens"]
+        self.context_fill_ratio = generation_setting["context_fill_ratio"]
 
-        self.max_input_tokens = self.context_len - self.max_output_tokens
+        # prompt and answer fill the context window up to the configured ratio
+        self.max_input_tokens = (
+            int(self.context_len * self.context_fill_ratio) - self.max_output_tokens
+        )
 
         self.retrieval_top_k = self.max_input_tokens // rag_setting["chunk_size"] - 1
         self.retrieval_top_k = min(max(1, self.retrieval_top_k), rag_setting["max_retrieval_top_k"])
         self.search_index = None
         self.retriever = None
-
+        # keyword index of the same nodes as the search index
+        self.bm25_index: Optional[BM25Index] = None
+        self.vector_store: Optional[LocalVectorStore] = None
+        # file path -> (index store key, ids of the file's nodes in the search index)
+        self.indexed_files: Dict[str, Tuple[Optional[str], List[str]]] = {}
+
+        # the llama.cpp context is used from several threads: prefill, condensation and decoding
+        # run in executor threads, summarization runs in the background between turns
+        self.llm_lock = Lock()
         self.chat_history = ChatHistory(
             llm=llm,
             max_output_tokens=self.max_output_tokens,
             max_history_size=self.max_input_tokens,
+            llm_lock=self.llm_lock,
+        )
+        self.system_prompt_size = (
+            self.chat_history.count_tokens(SYSTEM_PROMPT["content"]) + MESSAGE_OVERHEAD_TOKENS
         )
         self.lookup_files = set()
 
-        self.embed_model = HuggingFaceEmbedding(model_name=rag_setting["embed_model_name"])
-        Settings.embed_model = self.embed_model
-        Settings.chunk_size = rag_setting["chunk_size"]
-        Settings.chunk_overlap = rag_setting["chunk_overlap"]
+        # the embed model itself is only loaded when documents are indexed
+        self.embed_model_name = rag_setting["embed_model_name"]
+        self.chunk_size = rag_setting["chunk_size"]
+        self.chunk_overlap = rag_setting["chunk_overlap"]
+        self.embedding_cache_mb = rag_setting["embedding_cache_mb"]
+        self.embed_batch_size = rag_setting["embed_batch_size"]
         self.node_processor = SimilarityPostprocessor(
             similarity_cutoff=rag_setting["similarity_threshold"]
         )
         self.llm = llm
+        # optional smaller model for query condensation, set by the model handler
+        self.condense_llm: Optional[Llama] = None
+        self.condense_skip_score = rag_setting["condense_skip_score"]
+        self.condense_stats = {"condensed": 0, "skipped": 0}
+        self._set_rerank_setting(rag_setting)
+
+    def _set_rerank_setting(self, rag_setting: Dict):
+        self.rerank_model = rag_setting["rerank_model"]
+        self.rerank_candidates = rag_setting["rerank_candidates"]
+        self.rerank_batch_size = rag_setting["rerank_batch_size"]
+        self.rerank_budget_ms = rag_setting["rerank_budget_ms"]
+        if self.rerank_model:
+            preload_reranker(self.rerank_model)
+
+    @property
+    def candidate_top_k(self) -> int:
+        """Number of chunks to retrieve, more than fit into the prompt if they are reranked"""
+        if self.rerank_model:
+            return max(self.rerank_candidates, self.retrieval_top_k)
+        return self.retrieval_top_k
 
     def update_index(self, files: Optional[Set[str]] = set()):
         if not files:
             print("No lookup files provided, clearing index...")
             self.retriever = None
             self.search_index = None
+            self.bm25_index = None
+            self.vector_store = None
+            self.indexed_files = {}
             return
 
-        print("Indexing documents...")
-        documents = SimpleDirectoryReader(input_files=files, recursive=True).load_data(
-            show_progress=True, num_workers=1
+        embed_model = shared_embed_model.get(self.embed_model_name, self.embed_batch_size)
+        if self.search_index is None:
+            # exact search for a few documents, an IVF index once thousands of chunks are indexed
+            self.vector_store = LocalVectorStore()
+            self.search_index = VectorStoreIndex(
+                nodes=[],
+                embed_model=embed_model,
+                storage_context=StorageContext.from_defaults(vector_store=self.vector_store),
+            )
+            self.bm25_index = BM25Index()
+            self.indexed_files = {}
+
+        # drop the nodes of files that were removed or changed on disk since they were indexed
+        for file_path, (key, node_ids) in list(self.indexed_files.items()):
+            if file_path in files and key == self._get_file_key(file_path):
+                continue
+            print(f"Removing {file_path} from index...")
+            self.search_index.delete_nodes(node_ids, delete_from_docstore=True)
+            self.bm25_index.remove_nodes(node_ids)
+            del self.indexed_files[file_path]
+
+        # only parse and embed the files that are not in the index yet
+        new_files = sorted(file_path for file_path in files if file_path not in self.indexed_files)
+        if new_files:
+            print("Indexing documents...")
+
+        # file path -> index store key, computed before parsing in case the file changes meanwhile
+        files_to_parse = {}
+        for file_path in new_files:
+            key = self._get_file_key(file_path)
+            nodes = index_store.get(key) if key else None
+            if nodes is None:
+                files_to_parse[file_path] = key
+                continue
+            print(f"Loaded {len(nodes)} cached nodes for {file_path}")
+            self._insert_file_nodes(file_path, key, nodes)
+
+        # files are parsed concurrently and chunked/embedded as soon as each one is ready
+        if files_to_parse:
+            splitter = SentenceSplitter(
+                chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap
+            )
+            pipeline = EmbeddingPipeline(
+                embed_model,
+                get_embedding_cache(self.embed_model_name, self.embedding_cache_mb),
+                batch_size=self.embed_batch_size,
+            )
+            try:
+                for file_path, documents, parse_time in parse_files(list(files_to_parse)):
+                    print(f"Parsed {file_path} in {parse_time:.2f}s")
+                    key = files_to_parse[file_path]
+                    nodes = splitter.get_nodes_from_documents(documents)
+                    pipeline.submit(
+                        nodes,
+                        on_done=lambda nodes, file_path=file_path, key=key: (
+                            self._on_file_embedded(file_path, key, nodes)
+                        ),
+                    )
+            finally:
+                pipeline.join()
+
+        self.vector_store.build()
+        self.retriever = self.search_index.as_retriever(similarity_top_k=self.candidate_top_k)
+
+    def _get_file_key(self, file_path: str) -> Optional[str]:
+        return index_store.get_key(
+            file_path, self.embed_model_name, self.chunk_size, self.chunk_overlap
         )
 
-        self.search_index = VectorStoreIndex.from_documents(documents, embed_model=self.embed_model)
+    def _on_file_embedded(self, file_path: str, key: Optional[str], nodes: List[BaseNode]):
+        if key:
+            index_store.put(key, nodes)
+        self._insert_file_nodes(file_path, key, nodes)
 
-        self.retriever = self.search_index.as_retriever(similarity_top_k=self.retrieval_top_k)
+    def _insert_file_nodes(self, file_path: str, key: Optional[str], nodes: List[BaseNode]):
+        # nodes already carry their embeddings, so inserting them does not embed again
+        self.search_index.insert_nodes(nodes)
+        self.bm25_index.add_nodes(nodes)
+        self.indexed_files[file_path] = (key, [node.node_id for node in nodes])
 
     def update_rag_setting(self, rag_setting: Dict):
+        self.condense_skip_score = rag_setting["condense_skip_score"]
+        self.embedding_cache_mb = rag_setting["embedding_cache_mb"]
+        self.embed_batch_size = rag_setting["embed_batch_size"]
         if self.node_processor.similarity_cutoff != rag_setting["similarity_threshold"]:
             self.node_processor = SimilarityPostprocessor(
                 similarity_cutoff=rag_setting["similarity_threshold"]
@@ -223,39 +587,41 @@ class RAGAgent(Workflow):
 
         new_top_k = (self.context_len - rag_setting["chunk_size"]) // rag_setting["chunk_overlap"]
         new_top_k = min(max(1, new_top_k), rag_setting["max_retrieval_top_k"])
-        if self.retrieval_top_k != new_top_k:
-            self.retrieval_top_k = new_top_k
-            if self.retriever:
-                self.retriever = self.search_index.as_retriever(
-                    similarity_top_k=self.retrieval_top_k
-                )
+        candidate_top_k = self.candidate_top_k
+        self.retrieval_top_k = new_top_k
+        self._set_rerank_setting(rag_setting)
+        if self.retriever and self.candidate_top_k != candidate_top_k:
+            self.retriever = self.search_index.as_retriever(similarity_top_k=self.candidate_top_k)
 
         if (
-            self.embed_model.model_name != rag_setting["embed_model_name"]
-            or Settings.chunk_size != rag_setting["chunk_size"]
-            or Settings.chunk_overlap != rag_setting["chunk_overlap"]
+            self.embed_model_name != rag_setting["embed_model_name"]
+            or self.chunk_size != rag_setting["chunk_size"]
+            or self.chunk_overlap != rag_setting["chunk_overlap"]
         ):
-            self.embed_model = HuggingFaceEmbedding(model_name=rag_setting["embed_model_name"])
-            Settings.embed_model = self.embed_model
-            Settings.chunk_size = rag_setting["chunk_size"]
-            Settings.chunk_overlap = rag_setting["chunk_overlap"]
+            self.embed_model_name = rag_setting["embed_model_name"]
+            self.chunk_size = rag_setting["chunk_size"]
+            self.chunk_overlap = rag_setting["chunk_overlap"]
 
             # reindex since those are the settings that affect the index
+            self.search_index = None
             if self.lookup_files:
                 print("Re-indexing documents since the rag settings have changed...")
-                documents = SimpleDirectoryReader(
-                    input_files=self.lookup_files, recursive=True
-                ).load_data(show_progress=True, num_workers=1)
-                self.search_index = VectorStoreIndex.from_documents(
-                    documents, embed_model=self.embed_model
-                )
-                self.retriever = self.search_index.as_retriever(
-                    similarity_top_k=self.retrieval_top_k
-                )
+                self.update_index(self.lookup_files)
 
     def update_generation_setting(self, generation_setting):
         self.generation_setting = generation_setting
         self.context_len = generation_setting["context_len"]
+        if (
+            self.max_output_tokens != generation_setting["max_output_tokens"]
+            or self.context_fill_ratio != generation_setting["context_fill_ratio"]
+        ):
+            self.max_output_tokens = generation_setting["max_output_tokens"]
+            self.context_fill_ratio = generation_setting["context_fill_ratio"]
+            self.max_input_tokens = (
+                int(self.context_len * self.context_fill_ratio) - self.max_output_tokens
+            )
+            self.chat_history.max_output_tokens = self.max_output_tokens
+            self.chat_history.set_max_history_size(self.max_input_tokens)
 
     @step
     async def setup(self, ctx: Context, ev: StartEvent) -> SetupEvent:
@@ -267,10 +633,26 @@ class RAGAgent(Workflow):
         await ctx.store.set("query_str", query_str)
         await ctx.store.set("image", image)
         await ctx.store.set("streaming", streaming)
+        await ctx.store.set("cancel_event", ev.get("cancel_event"))
+
+        # the summary started after the previous turn replaces the history this query builds on
+        if self.chat_history.is_summarizing():
+            ctx.write_event_to_stream(ProgressEvent(message="Summarizing the conversation ...."))
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.chat_history.wait_for_summary)
+
+        # evaluate the system prompt and the chat history while the documents are searched
+        if lookup_files and not image:
+            loop = asyncio.get_running_loop()
+            prefix_messages = [SYSTEM_PROMPT] + self.chat_history.get_chat_history()
+            await ctx.store.set(
+                "prefill", loop.run_in_executor(None, self._prefill, prefix_messages)
+            )
 
         # update index if needed
         if lookup_files != self.lookup_files:
             print("Different lookup files, updating index...")
+            ctx.write_event_to_stream(ProgressEvent(message="Indexing documents ...."))
             self.update_index(lookup_files)
 
         self.lookup_files = lookup_files.copy()
@@ -283,16 +665,127 @@ class RAGAgent(Workflow):
         Condense the chat history and the query into a single query. Only used for retrieval.
         """
         query_str = await ctx.store.get("query_str")
+        cancel_event = await ctx.store.get("cancel_event", default=None)
+
+        if len(self.chat_history) == 0 or self.retriever is None:
+            # if there is no history or no need for retrieval, return the query as is
+            return CondenseQueryEvent(condensed_query_str=query_str)
+
+        if not self._refers_to_history(query_str):
+            # the query looks stand-alone, condensing is skipped if it already retrieves well
+            nodes = await self.retriever.aretrieve(query_str)
+            best_score = max((node.score or 0.0 for node in nodes), default=0.0)
+            if best_score >= self.condense_skip_score:
+                self.condense_stats["skipped"] += 1
+                self._print_condense_stats(f"skipped, best score {best_score:.2f}")
+                await ctx.store.set("query_nodes", nodes)
+                return CondenseQueryEvent(condensed_query_str=query_str)
+
+        ctx.write_event_to_stream(ProgressEvent(message="Condensing the question ...."))
+        start_time = time.time()
+        loop = asyncio.get_running_loop()
+        standalone_query = await loop.run_in_executor(
+            None, self._condense_query, query_str, cancel_event
+        )
+        self.condense_stats["condensed"] += 1
+        self._print_condense_stats(f"took {time.time() - start_time:.2f}s")
+
+        condensed_query = standalone_query + "\nQuestion: " + query_str
 
-        if len(self.chat_history) > 0 and self.retriever is not None:
-            standalone_query = self.llm.create_chat_completion(
+        return CondenseQueryEvent(condensed_query_str=condensed_query)
+
+    @step
+    async def retrieve(self, ctx: Context, ev: CondenseQueryEvent) -> RetrievalEvent:
+        if not self.retriever:
+            return RetrievalEvent(nodes=[])
+
+        # retrieve from dropped documents, unless the query was already used as is
+        ctx.write_event_to_stream(ProgressEvent(message="Searching documents ...."))
+        condensed_query_str = ev.condensed_query_str
+        dense_nodes = await ctx.store.get("query_nodes", default=None)
+        nodes = await self._hybrid_retrieve(condensed_query_str, dense_nodes)
+        ctx.write_event_to_stream(
+            ProgressEvent(message=f"Retrieved {len(nodes)} relevant chunks ....")
+        )
+        return RetrievalEvent(nodes=nodes, query_str=condensed_query_str)
+
+    @step
+    async def rerank(self, ctx: Context, ev: RetrievalEvent) -> RerankEvent:
+        nodes = ev.nodes
+        if not self.rerank_model or len(nodes) <= 1:
+            return RerankEvent(nodes=nodes[: self.retrieval_top_k])
+
+        ctx.write_event_to_stream(ProgressEvent(message="Reranking chunks ...."))
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        reranker = await loop.run_in_executor(None, get_reranker, self.rerank_model)
+        if reranker is None:
+            return RerankEvent(nodes=nodes[: self.retrieval_top_k])
+
+        # waiting for the reranker to finish loading counts against the budget
+        budget_ms = self.rerank_budget_ms - int((time.time() - start_time) * 1000)
+        nodes = await loop.run_in_executor(
+            None,
+            reranker.rerank,
+            ev.query_str,
+            nodes,
+            self.retrieval_top_k,
+            self.rerank_batch_size,
+            budget_ms,
+        )
+        return RerankEvent(nodes=nodes)
+
+    async def _hybrid_retrieve(
+        self, query_str: str, dense_nodes: Optional[List[NodeWithScore]] = None
+    ) -> List[NodeWithScore]:
+        """Fuse the dense and the keyword results with reciprocal rank fusion. dense_nodes are
+        results of the dense retriever for the same query, if it was already run."""
+        start_time = time.time()
+        if dense_nodes is None:
+            dense_nodes = await self.retriever.aretrieve(query_str)
+        dense_nodes = self.node_processor.postprocess_nodes(dense_nodes)
+        dense_time = time.time() - start_time
+
+        start_time = time.time()
+        keyword_hits = self.bm25_index.search(query_str, self.candidate_top_k)
+        if keyword_hits:
+            min_score = keyword_hits[0][1] * BM25_MIN_RELATIVE_SCORE
+            keyword_hits = [(node, score) for node, score in keyword_hits if score >= min_score]
+        keyword_time = time.time() - start_time
+
+        fused: Dict[str, Tuple[BaseNode, float]] = {}
+        ranked_lists = [[result.node for result in dense_nodes], [node for node, _ in keyword_hits]]
+        for ranked_nodes in ranked_lists:
+            for rank, node in enumerate(ranked_nodes):
+                _, score = fused.get(node.node_id, (node, 0.0))
+                fused[node.node_id] = (node, score + 1 / (RRF_K + rank + 1))
+
+        # scale so that a node ranked first by both retrievers scores 1
+        max_score = 2 / (RRF_K + 1)
+        nodes = [
+            NodeWithScore(node=node, score=score / max_score)
+            for node, score in sorted(fused.values(), key=lambda item: item[1], reverse=True)
+        ][: self.candidate_top_k]
+        print(
+            f"Retrieved {len(dense_nodes)} dense matches in {dense_time * 1000:.0f}ms and "
+            f"{len(keyword_hits)} keyword matches in {keyword_time * 1000:.0f}ms, "
+            f"{len(nodes)} after fusion"
+        )
+        return nodes
+
+    def _condense_query(self, query_str: str, cancel_event: Optional[ThreadingEvent]) -> str:
+        llm = self.condense_llm or self.llm
+        # the draft model belongs to this agent alone and can run next to the prefill
+        with self.llm_lock if llm is self.llm else nullcontext():
+            return llm.create_chat_completion(
                 messages=[SYSTEM_PROMPT]
                 + self.chat_history.get_chat_history()
                 + [
                     {
                         "role": "user",
                         "content": query_str
-                        + "\n Condense this conversation to stand-alone question using only 1 sentence.",
+                        + "\n Condense this conversation to stand-alone question "
+                        "using only 1 sentence.",
                     }
                 ],
                 stream=False,
@@ -300,70 +793,82 @@ class RAGAgent(Workflow):
                 top_p=self.generation_setting["top_p"],
                 temperature=self.generation_setting["temperature"],
                 max_tokens=128,
+                stopping_criteria=self._get_stopping_criteria(cancel_event),
             )["choices"][0]["message"]["content"]
 
-            condensed_query = standalone_query + "\nQuestion: " + query_str
-
-        else:
-            # if there is no history or no need for retrieval, return the query as is
-            condensed_query = query_str
+    def _prefill(self, prefix_messages: List[Dict]):
+        """Evaluate the prompt up to the new user turn, so that generating only has to evaluate
+        the retrieved context and the query. llama.cpp reuses the matching prefix of its KV
+        cache."""
+        start_time = time.time()
+        try:
+            with self.llm_lock:
+                self.llm.create_chat_completion(
+                    messages=prefix_messages + [{"role": "user", "content": ""}],
+                    max_tokens=1,
+                    temperature=0.0,
+                )
+        except Exception as e:
+            print(f"Prefill failed: {e}")
+            return
+        print(f"Prefilled {self.llm.n_tokens} tokens in {time.time() - start_time:.2f}s")
 
-        return CondenseQueryEvent(condensed_query_str=condensed_query)
+    @staticmethod
+    def _refers_to_history(query_str: str) -> bool:
+        words = [word.strip(".,;:!?\"'()").lower() for word in query_str.split()]
+        return len(words) < MIN_STANDALONE_QUERY_WORDS or any(
+            word in REFERRING_WORDS for word in words
+        )
 
-    @step
-    async def retrieve(self, ctx: Context, ev: CondenseQueryEvent) -> RetrievalEvent:
-        if not self.retriever:
-            return RetrievalEvent(nodes=[])
+    def _print_condense_stats(self, message: str):
+        total = self.condense_stats["condensed"] + self.condense_stats["skipped"]
+        print(
+            f"Query condensation {message} "
+            f"(skipped {self.condense_stats['skipped']}/{total} turns)"
+        )
 
-        # retrieve from dropped documents
-        condensed_query_str = ev.condensed_query_str
-        nodes = await self.retriever.aretrieve(condensed_query_str)
-        nodes = self.node_processor.postprocess_nodes(nodes)
-        return RetrievalEvent(nodes=nodes)
+    @staticmethod
+    def _get_stopping_criteria(
+        cancel_event: Optional[ThreadingEvent],
+    ) -> Optional[StoppingCriteriaList]:
+        """Stop decoding at the next token once the request is cancelled"""
+        if cancel_event is None:
+            return None
+        return StoppingCriteriaList([lambda input_ids, logits: cancel_event.is_set()])
 
     def _prepare_query_with_context(
         self,
         query_str: str,
         nodes: List[NodeWithScore],
     ) -> str:
-        node_context = ""
-
         if len(nodes) == 0:
             return query_str
 
         # Calculate available space for RAG context
-        # Reserve space for: system prompt, chat history, query, and output
-        chat_history_size = self.chat_history.total_size
-        query_size = len(query_str.split())
-
-        # Convert words to approximate tokens (1 word ≈ 1.3 tokens)
-        estimated_tokens_used = int((chat_history_size + query_size) * 1.3)
+        # Reserve space for: system prompt, chat history, query and the prompt template
+        template_size = (
+            self.chat_history.count_tokens(
+                self.CONTEXT_PROMPT_TEMPLATE.format(node_context="", query_str=query_str)
+            )
+            + MESSAGE_OVERHEAD_TOKENS
+        )
         available_tokens = (
-            self.context_len - self.max_output_tokens - estimated_tokens_used - 200
-        )  # 200 buffer
-
-        # Convert available tokens to words
-        max_context_words = int(available_tokens / 1.3)
+            self.max_input_tokens
+            - self.system_prompt_size
+            - self.chat_history.total_size
+            - template_size
+        )
 
-        if max_context_words < 100:
+        if available_tokens < MIN_CONTEXT_TOKENS:
             # Not enough space for RAG context, return query without context
             print(
-                f"Warning: Not enough context space for RAG. Available: {max_context_words} words"
+                f"Warning: Not enough context space for RAG. Available: {available_tokens} tokens"
             )
             return query_str
 
-        # Add nodes until we reach the limit
-        current_words = 0
-        for idx, node in enumerate(nodes):
-            node_text = node.get_content(metadata_mode="llm")
-            node_words = len(node_text.split())
-
-            if current_words + node_words > max_context_words:
-                print(f"Truncating RAG context at node {idx} to fit within context window")
-                break
-
-            node_context += f"\n{node_text}\n\n"
-            current_words += node_words
+        # merge overlapping chunks and fit the best scoring ones into the remaining tokens
+        passages = ContextPacker(self.chat_history.count_tokens).pack(nodes, available_tokens)
+        node_context = "".join(passages)
 
         if not node_context:
             return query_str
@@ -375,12 +880,13 @@ class RAGAgent(Workflow):
         return formatted_query
 
     @step
-    async def llm_response(self, ctx: Context, retrieval_ev: RetrievalEvent) -> StopEvent:
-        nodes = retrieval_ev.nodes
+    async def llm_response(self, ctx: Context, rerank_ev: RerankEvent) -> StopEvent:
+        nodes = rerank_ev.nodes
         query_str = await ctx.store.get("query_str")
         image = await ctx.store.get("image")
         query_with_ctx = self._prepare_query_with_context(query_str, nodes)
         streaming = await ctx.store.get("streaming", default=False)
+        cancel_event = await ctx.store.get("cancel_event", default=None)
 
         if image:
             formated_message = {
@@ -398,16 +904,100 @@ class RAGAgent(Workflow):
             [SYSTEM_PROMPT] + self.chat_history.get_chat_history() + [formated_message]
         )
 
-        response = self.llm.create_chat_completion(
-            messages=messages_for_llm,
-            stream=streaming,
-            top_k=self.generation_setting["top_k"],
-            top_p=self.generation_setting["top_p"],
-            temperature=self.generation_setting["temperature"],
-            max_tokens=self.max_output_tokens,
-        )
-
         # Store the user message to be added to history after response is complete
         await ctx.store.set("user_message", formated_message)
 
-        return StopEvent(result=response)
+        # the prefix has been evaluated while the documents were searched
+        prefill = await ctx.store.get("prefill", default=None)
+        if prefill is not None:
+            await prefill
+
+        # decoding runs on an executor thread that holds the model lock. The event loop must
+        # never wait for the lock: a cancelled run still needs the loop to finish
+        loop = asyncio.get_running_loop()
+        if not streaming:
+            response = await loop.run_in_executor(
+                None, self._complete, messages_for_llm, cancel_event
+            )
+            return StopEvent(result=response)
+
+        # stream the chunks through the workflow event stream, the full text is the result
+        ctx.write_event_to_stream(ProgressEvent(message="Generating ...."))
+        start_time = time.time()
+        chunks: asyncio.Queue = asyncio.Queue()
+        stop_event = ThreadingEvent()
+        decoding = loop.run_in_executor(
+            None,
+            self._stream_completion,
+            messages_for_llm,
+            cancel_event,
+            stop_event,
+            lambda chunk: loop.call_soon_threadsafe(chunks.put_nowait, chunk),
+        )
+        # queued after the last chunk
+        decoding.add_done_callback(lambda _: chunks.put_nowait(None))
+        response_text = ""
+        first_token = True
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                delta = chunk["choices"][0]["delta"]
+                if first_token and "content" in delta:
+                    first_token = False
+                    ctx.write_event_to_stream(
+                        ProgressEvent(
+                            message=f"First token after {time.time() - start_time:.2f}s",
+                            loading=False,
+                        )
+                    )
+                response_text += delta.get("content") or ""
+                ctx.write_event_to_stream(TokenEvent(chunk=chunk))
+        except asyncio.CancelledError:
+            # the decoding thread stops at the next token and releases the lock on its own
+            stop_event.set()
+            raise
+        # raise the exception of a failed completion
+        await decoding
+
+        return StopEvent(result=response_text)
+
+    def _complete(self, messages: List[Dict], cancel_event: Optional[ThreadingEvent]) -> Dict:
+        with self.llm_lock:
+            return self.llm.create_chat_completion(
+                messages=messages,
+                stream=False,
+                top_k=self.generation_setting["top_k"],
+                top_p=self.generation_setting["top_p"],
+                temperature=self.generation_setting["temperature"],
+                max_tokens=self.max_output_tokens,
+                stopping_criteria=self._get_stopping_criteria(cancel_event),
+            )
+
+    def _stream_completion(
+        self,
+        messages: List[Dict],
+        cancel_event: Optional[ThreadingEvent],
+        stop_event: ThreadingEvent,
+        on_chunk: Callable[[Dict], None],
+    ):
+        """Decode a streamed completion, passing each chunk to on_chunk. Stops once stop_event
+        is set, closing the completion before the lock is released."""
+        with self.llm_lock:
+            response = self.llm.create_chat_completion(
+                messages=messages,
+                stream=True,
+                top_k=self.generation_setting["top_k"],
+                top_p=self.generation_setting["top_p"],
+                temperature=self.generation_setting["temperature"],
+                max_tokens=self.max_output_tokens,
+                stopping_criteria=self._get_stopping_criteria(cancel_event),
+            )
+            try:
+                for chunk in response:
+                    if stop_event.is_set():
+                        break
+                    on_chunk(chunk)
+            finally:
+                response.close()
@@ -0,0 +1,110 @@
+import math
+import re
+from collections import Counter
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from llama_index.core.schema import BaseNode, MetadataMode
+
+# words, optionally joined by - . : / _ as in error codes, part numbers and identifiers
+TOKEN_PATTERN = re.compile(r"\w+(?:[-.:/]\w+)*")
+# words that match almost any chunk, a question unrelated to the documents would match on them
+STOP_WORDS = set(
+    "a an and are as at be been but by can could did do does for from had has have how i if in "
+    "into is it its me my no not of on or our should so than that the their them then there "
+    "these they this to was we were what when where which who why will with would you your".split()
+)
+# query terms found in more than this share of the chunks are ignored
+MAX_DOC_FREQUENCY = 0.5
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased words without stop words. Compound identifiers are kept whole and also split
+    into their parts, so "ERR-4012" matches both "err-4012" and "4012"."""
+    tokens = []
+    for match in TOKEN_PATTERN.findall(text.lower()):
+        if match in STOP_WORDS:
+            continue
+        tokens.append(match)
+        parts = re.split(r"[-.:/_]", match)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part and part not in STOP_WORDS)
+    return tokens
+
+
+class BM25Index:
+    """
+    In-memory inverted index with Okapi BM25 scoring.
+
+    Dense retrieval finds passages with a similar meaning but misses exact identifiers, error
+    codes and part numbers, which keyword search matches reliably. Nodes are added and removed
+    incrementally along with the vector index.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> node id -> term frequency
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_lengths: Dict[str, int] = {}
+        self.total_length = 0
+        self.nodes: Dict[str, BaseNode] = {}
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add_nodes(self, nodes: List[BaseNode]):
+        term_counts = [
+            Counter(tokenize(node.get_content(metadata_mode=MetadataMode.EMBED))) for node in nodes
+        ]
+        with self.lock:
+            for node, counts in zip(nodes, term_counts):
+                if node.node_id in self.nodes:
+                    self._remove_node(node.node_id)
+                self.nodes[node.node_id] = node
+                length = sum(counts.values())
+                self.doc_lengths[node.node_id] = length
+                self.total_length += length
+                for term, count in counts.items():
+                    self.postings.setdefault(term, {})[node.node_id] = count
+
+    def remove_nodes(self, node_ids: List[str]):
+        with self.lock:
+            for node_id in node_ids:
+                if node_id in self.nodes:
+                    self._remove_node(node_id)
+
+    def _remove_node(self, node_id: str):
+        node = self.nodes.pop(node_id)
+        self.total_length -= self.doc_lengths.pop(node_id)
+        for term in set(tokenize(node.get_content(metadata_mode=MetadataMode.EMBED))):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(node_id, None)
+                if not postings:
+                    del self.postings[term]
+
+    def search(self, query_str: str, top_k: int) -> List[Tuple[BaseNode, float]]:
+        """Return up to top_k (node, score) pairs with a positive score, best first"""
+        query_terms = set(tokenize(query_str))
+        with self.lock:
+            num_docs = len(self.nodes)
+            if num_docs == 0:
+                return []
+            avg_length = self.total_length / num_docs
+
+            scores: Dict[str, float] = {}
+            for term in query_terms:
+                postings = self.postings.get(term)
+                if not postings or len(postings) > max(1, num_docs * MAX_DOC_FREQUENCY):
+                    continue
+                idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for node_id, tf in postings.items():
+                    length_norm = 1 - self.b + self.b * self.doc_lengths[node_id] / avg_length
+                    scores[node_id] = scores.get(node_id, 0.0) + idf * tf * (self.k1 + 1) / (
+                        tf + self.k1 * length_norm
+                    )
+
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+            return [(self.nodes[node_id], score) for node_id, score in best]
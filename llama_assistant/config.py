@@ -19,6 +19,7 @@ DEFAULT_SETTINGS = {
         "top_k": 40,
         "top_p": 0.95,
         "temperature": 0.2,
+        "context_fill_ratio": 0.95,
     },
     "rag": {
         "embed_model_name": "BAAI/bge-base-en-v1.5",
@@ -26,6 +27,26 @@ DEFAULT_SETTINGS = {
         "chunk_overlap": 128,
         "max_retrieval_top_k": 3,
         "similarity_threshold": 0.6,
+        "embedding_cache_mb": 256,
+        "embed_batch_size": 32,
+        "condense_model": "",
+        "condense_skip_score": 0.75,
+        "rerank_model": "",
+        "rerank_candidates": 30,
+        "rerank_batch_size": 8,
+        "rerank_budget_ms": 500,
+    },
+    "performance": {
+        "model_pool_memory_mb": 8192,
+        "prompt_cache_ram_mb": 1024,
+        "prompt_cache_disk_enabled": False,
+        "prompt_cache_disk_mb": 4096,
+        "restore_session": True,
+        "preload_text_model": True,
+        "preload_reasoning_model": False,
+        "preload_multimodal_model": False,
+        "stream_flush_interval_ms": 33,
+        "max_queued_requests": 4,
     },
 }
 
@@ -36,12 +57,26 @@ VALIDATOR = {
         "top_k": {"type": "int", "min": 1, "max": 100},
         "top_p": {"type": "float", "min": 0, "max": 1},
         "temperature": {"type": "float", "min": 0, "max": 1},
+        "context_fill_ratio": {"type": "float", "min": 0.5, "max": 1},
     },
     "rag": {
         "chunk_size": {"type": "int", "min": 64, "max": 512},
         "chunk_overlap": {"type": "int", "min": 64, "max": 256},
         "max_retrieval_top_k": {"type": "int", "min": 1, "max": 5},
         "similarity_threshold": {"type": "float", "min": 0, "max": 1},
+        "embedding_cache_mb": {"type": "int", "min": 16},
+        "embed_batch_size": {"type": "int", "min": 1, "max": 512},
+        "condense_skip_score": {"type": "float", "min": 0, "max": 1},
+        "rerank_candidates": {"type": "int", "min": 5, "max": 100},
+        "rerank_batch_size": {"type": "int", "min": 1, "max": 64},
+        "rerank_budget_ms": {"type": "int", "min": 10, "max": 10000},
+    },
+    "performance": {
+        "model_pool_memory_mb": {"type": "int", "min": 1024},
+        "prompt_cache_ram_mb": {"type": "int", "min": 0},
+        "prompt_cache_disk_mb": {"type": "int", "min": 0},
+        "stream_flush_interval_ms": {"type": "int", "min": 0, "max": 1000},
+        "max_queued_requests": {"type": "int", "min": 1, "max": 64},
     },
 }
 
@@ -232,6 +267,10 @@ settings_file = llama_assistant_dir / "settings.json"
 actions_file = llama_assistant_dir / "actions.json"
 document_icon = "llama_assistant/resources/document_icon.png"
 ocr_tmp_file = llama_assistant_dir / "ocr_tmp.png"
+index_cache_dir = llama_assistant_dir / "index_cache"
+embedding_cache_dir = llama_assistant_dir / "embedding_cache"
+prompt_cache_dir = llama_assistant_dir / "prompt_cache"
+session_dir = llama_assistant_dir / "sessions"
 
 if custom_models_file.exists():
     with open(custom_models_file, "r") as f:
@@ -0,0 +1,135 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llama_index.core.schema import MetadataMode, NodeWithScore
+
+# budgets are packed in steps of this many tokens, which keeps the knapsack table small
+TOKEN_GRANULARITY = 8
+
+
+def _get_weight(tokens: int) -> int:
+    """Knapsack weight of a passage, rounded up so that the chosen passages never exceed the
+    budget"""
+    return -(-tokens // TOKEN_GRANULARITY)
+
+
+class Passage:
+    """A contiguous span of one document, made of one or more retrieved chunks"""
+
+    def __init__(self, node: NodeWithScore):
+        self.doc_id = node.node.ref_doc_id
+        self.start = node.node.start_char_idx
+        self.end = node.node.end_char_idx
+        self.text = node.node.get_content(metadata_mode=MetadataMode.NONE)
+        self.metadata_str = node.node.get_metadata_str(mode=MetadataMode.LLM)
+        self.score = node.score or 0.0
+        self.nodes = [node]
+
+    @property
+    def has_offsets(self) -> bool:
+        return self.doc_id is not None and self.start is not None and self.end is not None
+
+    def try_merge(self, other: "Passage") -> bool:
+        """Append a passage of the same document that overlaps or touches this one"""
+        if other.start > self.end:
+            return False
+        # passages are merged in order of their start, so other starts inside this one
+        offset = other.start - self.start
+        overlap = min(self.end, other.end) - other.start
+        if self.text[offset : offset + overlap] != other.text[:overlap]:
+            # offsets do not match the texts, e.g. the splitter could not locate the chunk
+            return False
+
+        if other.end > self.end:
+            self.text += other.text[overlap:]
+            self.end = other.end
+        self.score = max(self.score, other.score)
+        self.nodes.extend(other.nodes)
+        return True
+
+    def format(self) -> str:
+        content = f"{self.metadata_str}\n\n{self.text}" if self.metadata_str else self.text
+        return f"\n{content}\n\n"
+
+
+class ContextPacker:
+    """
+    Pack retrieved chunks into a token budget for the prompt.
+
+    Overlapping and adjacent chunks of the same document are merged into one passage, so text
+    shared by neighbouring chunks (chunk_overlap) is only sent once. The passages with the best
+    total retrieval score that fit into the budget are then chosen with a 0/1 knapsack.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int]):
+        self.count_tokens = count_tokens
+
+    def pack(self, nodes: List[NodeWithScore], budget: int) -> List[str]:
+        """Return the formatted passages to put into the prompt, best scoring first"""
+        passages = self._merge(nodes)
+        candidates: List[Tuple[Passage, str, int]] = []
+        for passage in passages:
+            text = passage.format()
+            tokens = self.count_tokens(text)
+            # compared the way the knapsack rounds, a passage within a few tokens of the budget
+            # may not fit either
+            if _get_weight(tokens) > budget // TOKEN_GRANULARITY and len(passage.nodes) > 1:
+                # too long as a whole, its chunks may still fit on their own
+                for node in passage.nodes:
+                    chunk = Passage(node)
+                    chunk_text = chunk.format()
+                    candidates.append((chunk, chunk_text, self.count_tokens(chunk_text)))
+            else:
+                candidates.append((passage, text, tokens))
+
+        selected = self._knapsack(candidates, budget)
+        used_tokens = sum(candidates[idx][2] for idx in selected)
+        print(
+            f"Packed {len(nodes)} retrieved chunks into {len(selected)}/{len(candidates)} "
+            f"passages, {used_tokens}/{budget} tokens"
+        )
+        selected.sort(key=lambda idx: candidates[idx][0].score, reverse=True)
+        return [candidates[idx][1] for idx in selected]
+
+    @staticmethod
+    def _merge(nodes: List[NodeWithScore]) -> List[Passage]:
+        passages: List[Passage] = []
+        seen_texts = set()
+        by_doc: Dict[str, List[Passage]] = {}
+        for node in nodes:
+            passage = Passage(node)
+            if passage.has_offsets:
+                by_doc.setdefault(passage.doc_id, []).append(passage)
+            elif passage.text not in seen_texts:
+                seen_texts.add(passage.text)
+                passages.append(passage)
+
+        for doc_passages in by_doc.values():
+            doc_passages.sort(key=lambda passage: (passage.start, -passage.end))
+            current: Optional[Passage] = None
+            for passage in doc_passages:
+                if current is None or not current.try_merge(passage):
+                    current = passage
+                    passages.append(current)
+        return passages
+
+    @staticmethod
+    def _knapsack(candidates: List[Tuple[Passage, str, int]], budget: int) -> List[int]:
+        """Indices of the candidates with the highest total score within the budget"""
+        capacity = budget // TOKEN_GRANULARITY
+        weights = [_get_weight(tokens) for _, _, tokens in candidates]
+        best = [0.0] * (capacity + 1)
+        chosen = [[False] * (capacity + 1) for _ in candidates]
+        for idx, ((passage, _, _), weight) in enumerate(zip(candidates, weights)):
+            for cap in range(capacity, weight - 1, -1):
+                value = best[cap - weight] + passage.score
+                if value > best[cap]:
+                    best[cap] = value
+                    chosen[idx][cap] = True
+
+        selected = []
+        cap = capacity
+        for idx in range(len(candidates) - 1, -1, -1):
+            if chosen[idx][cap]:
+                selected.append(idx)
+                cap -= weights[idx]
+        return selected
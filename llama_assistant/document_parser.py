@@ -0,0 +1,49 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, List, Tuple
+
+from llama_index.core import SimpleDirectoryReader
+from llama_index.core.schema import Document
+
+
+def parse_file(file_path: str) -> Tuple[str, List[Document], float]:
+    """Parse a single file into documents, returning the time it took"""
+    start_time = time.time()
+    documents = SimpleDirectoryReader(input_files=[file_path]).load_data()
+    return file_path, documents, time.time() - start_time
+
+
+def parse_files(file_paths: List[str]) -> Iterator[Tuple[str, List[Document], float]]:
+    """
+    Parse files concurrently in a process pool, yielding (file_path, documents, parse_time)
+    as soon as each file is parsed so that chunking and embedding can start right away.
+    """
+    if len(file_paths) <= 1:
+        for file_path in file_paths:
+            yield parse_file(file_path)
+        return
+
+    # a pool per call, its workers keep llama-index and the file readers imported and would
+    # hold that memory for the life of the app. spawn instead of fork: forking a process that
+    # runs Qt and llama.cpp threads is unsafe
+    executor = ProcessPoolExecutor(
+        max_workers=min(os.cpu_count() or 1, len(file_paths)),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    pending = set(file_paths)
+    try:
+        futures = [executor.submit(parse_file, file_path) for file_path in file_paths]
+        for future in as_completed(futures):
+            result = future.result()
+            pending.discard(result[0])
+            yield result
+    except BrokenProcessPool as e:
+        print(f"Document parsing pool failed, parsing remaining files serially: {e}")
+        for file_path in file_paths:
+            if file_path in pending:
+                yield parse_file(file_path)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
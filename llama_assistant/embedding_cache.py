@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from llama_assistant import config
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of chunk embeddings for a single embed model.
+
+    Vectors are stored in a memory-mapped float32 matrix with a fixed number of rows derived
+    from the size cap. The hash -> row mapping is kept in least recently used order and the
+    least recently used row is reused once the matrix is full. Changes are written to disk
+    with flush, once per indexing run.
+    """
+
+    def __init__(self, cache_dir: Path, max_size_mb: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.vectors_path = self.cache_dir / "vectors.f32"
+        self.index_path = self.cache_dir / "index.json"
+        self.dim: Optional[int] = None
+        self.capacity = 0
+        self.vectors: Optional[np.memmap] = None
+        # content hash -> row in the vectors matrix, least recently used first
+        self.slots: "OrderedDict[str, int]" = OrderedDict()
+        # the index on disk is behind the one in memory
+        self.dirty = False
+        self.lock = Lock()
+        self._load()
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _load(self):
+        if not self.index_path.exists() or not self.vectors_path.exists():
+            return
+
+        try:
+            with open(self.index_path, "r") as f:
+                index_data = json.load(f)
+            if index_data["capacity"] != self._get_capacity(index_data["dim"]):
+                # the size cap changed, start over with a matrix of the new size
+                return
+            self._allocate(index_data["dim"], index_data["capacity"], mode="r+")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring corrupted embedding cache {self.cache_dir}: {e}")
+            self.dim = None
+            self.vectors = None
+            return
+
+        self.slots = OrderedDict(index_data["entries"])
+
+    def _get_capacity(self, dim: int) -> int:
+        return max(1, self.max_size_bytes // (dim * np.dtype(np.float32).itemsize))
+
+    def _allocate(self, dim: int, capacity: int, mode: str = "w+"):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.capacity = capacity
+        self.vectors = np.memmap(
+            self.vectors_path, dtype=np.float32, mode=mode, shape=(capacity, dim)
+        )
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        with self.lock:
+            embeddings = []
+            for text in texts:
+                text_hash = self.hash_text(text)
+                slot = self.slots.get(text_hash)
+                if slot is None:
+                    embeddings.append(None)
+                    continue
+                self.slots.move_to_end(text_hash)
+                self.dirty = True
+                embeddings.append(self.vectors[slot].tolist())
+            return embeddings
+
+    def put_many(self, texts: List[str], embeddings: List[List[float]]):
+        if not texts:
+            return
+
+        with self.lock:
+            dim = len(embeddings[0])
+            if self.vectors is None or self.dim != dim:
+                self.slots.clear()
+                self._allocate(dim, self._get_capacity(dim))
+
+            for text, embedding in zip(texts, embeddings):
+                text_hash = self.hash_text(text)
+                if text_hash in self.slots:
+                    slot = self.slots.pop(text_hash)
+                elif len(self.slots) < self.capacity:
+                    slot = len(self.slots)
+                else:
+                    # reuse the row of the least recently used entry
+                    _, slot = self.slots.popitem(last=False)
+                self.vectors[slot] = np.asarray(embedding, dtype=np.float32)
+                self.slots[text_hash] = slot
+            self.dirty = True
+
+    def flush(self):
+        """Write the vectors and the index to disk"""
+        with self.lock:
+            if not self.dirty or self.vectors is None:
+                return
+            self._flush()
+            self.dirty = False
+
+    def _flush(self):
+        self.vectors.flush()
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "dim": self.dim,
+                    "capacity": self.capacity,
+                    "entries": list(self.slots.items()),
+                },
+                f,
+            )
+        os.replace(tmp_path, self.index_path)
+
+    def __len__(self):
+        return len(self.slots)
+
+
+_embedding_caches: Dict[str, EmbeddingCache] = {}
+_embedding_caches_lock = Lock()
+
+
+def get_embedding_cache(embed_model_name: str, max_size_mb: int) -> EmbeddingCache:
+    """Get the process-wide embedding cache of an embed model"""
+    with _embedding_caches_lock:
+        cache = _embedding_caches.get(embed_model_name)
+        if cache is None or cache.max_size_bytes != max_size_mb * 1024 * 1024:
+            cache_dir = config.embedding_cache_dir / embed_model_name.replace("/", "__")
+            cache = EmbeddingCache(cache_dir, max_size_mb)
+            _embedding_caches[embed_model_name] = cache
+        return cache
@@ -0,0 +1,103 @@
+import asyncio
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from typing import Any, AsyncIterator, Coroutine, Iterator
+
+EXECUTOR_MAX_WORKERS = 4
+
+
+class EventLoopRunner:
+    """
+    An event loop running for the lifetime of a loaded agent in its own thread.
+
+    Workflow runs of the agent are submitted to it from the processing threads, so the loop and
+    its default executor are set up once instead of on every query.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(
+            max_workers=EXECUTOR_MAX_WORKERS, thread_name_prefix=f"{name}-executor"
+        )
+        self.loop.set_default_executor(self.executor)
+        self.lock = Lock()
+        self.active_runs = 0
+        self.stopping = False
+        self.thread = Thread(target=self._run_loop, name=name, daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+        self.executor.shutdown(wait=False)
+
+    def _begin_run(self) -> bool:
+        with self.lock:
+            if self.stopping:
+                return False
+            self.active_runs += 1
+            return True
+
+    def _end_run(self):
+        with self.lock:
+            self.active_runs -= 1
+            if self.stopping and self.active_runs == 0:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self, coro: Coroutine) -> Any:
+        """Run a coroutine on the loop and wait for its result"""
+        if not self._begin_run():
+            # the agent was unloaded while the query was being set up, finish it on its own loop
+            return asyncio.run(coro)
+
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+        finally:
+            self._end_run()
+
+    def iterate(self, async_iterator: AsyncIterator) -> Iterator:
+        """Consume an async iterator on the loop, yielding its items in the calling thread"""
+        items = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for item in async_iterator:
+                    items.put((True, item))
+            except Exception as e:
+                items.put((False, e))
+            finally:
+                items.put((True, done))
+
+        if self._begin_run():
+            future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+            future.add_done_callback(lambda _: self._end_run())
+        else:
+            # same fallback as in run(), the items are collected before the first one is yielded
+            future = None
+            asyncio.run(pump())
+
+        try:
+            while True:
+                ok, item = items.get()
+                if not ok:
+                    raise item
+                if item is done:
+                    return
+                yield item
+        finally:
+            # the consumer stopped early, e.g. a cancelled response
+            if future is not None and not future.done():
+                future.cancel()
+
+    def stop(self):
+        """Stop the loop once the runs in progress have finished"""
+        with self.lock:
+            if self.stopping:
+                return
+            self.stopping = True
+            if self.active_runs == 0:
+                self.loop.call_soon_threadsafe(self.loop.stop)
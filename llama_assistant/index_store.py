@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import List, Optional
+
+from llama_index.core.schema import BaseNode
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+
+from llama_assistant import config
+
+
+class IndexStore:
+    """
+    Persistent store of chunked and embedded nodes for dropped documents.
+
+    Entries are keyed by file path, mtime, size, embed model and chunk settings, so a file
+    that has not changed since it was last indexed is served from memory or from disk
+    without being parsed or embedded again. The store is shared by all agents.
+    """
+
+    def __init__(self, cache_dir: Path, max_entries: int = 256, max_memory_entries: int = 64):
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max_entries
+        self.max_memory_entries = max_memory_entries
+        self.memory_cache: "OrderedDict[str, List[BaseNode]]" = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def get_key(
+        file_path: str, embed_model_name: str, chunk_size: int, chunk_overlap: int
+    ) -> Optional[str]:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        raw_key = "|".join(
+            [
+                os.path.abspath(file_path),
+                str(stat.st_mtime_ns),
+                str(stat.st_size),
+                embed_model_name,
+                str(chunk_size),
+                str(chunk_overlap),
+            ]
+        )
+        return hashlib.sha1(raw_key.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str) -> Optional[List[BaseNode]]:
+        with self.lock:
+            if key in self.memory_cache:
+                self.memory_cache.move_to_end(key)
+                return self.memory_cache[key]
+
+        entry_path = self._entry_path(key)
+        if not entry_path.exists():
+            return None
+
+        try:
+            with open(entry_path, "r") as f:
+                nodes = [json_to_doc(node_data) for node_data in json.load(f)]
+        except (OSError, ValueError) as e:
+            print(f"Ignoring corrupted index cache entry {entry_path}: {e}")
+            return None
+
+        # mark the entry as recently used so it survives pruning
+        os.utime(entry_path)
+        self._remember(key, nodes)
+        return nodes
+
+    def put(self, key: str, nodes: List[BaseNode]):
+        self._remember(key, nodes)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_path = self._entry_path(key)
+        tmp_path = entry_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump([doc_to_json(node) for node in nodes], f)
+        os.replace(tmp_path, entry_path)
+
+        self._prune()
+
+    def _remember(self, key: str, nodes: List[BaseNode]):
+        with self.lock:
+            self.memory_cache[key] = nodes
+            self.memory_cache.move_to_end(key)
+            while len(self.memory_cache) > self.max_memory_entries:
+                self.memory_cache.popitem(last=False)
+
+    def _prune(self):
+        entries = sorted(self.cache_dir.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for entry_path in entries[: max(0, len(entries) - self.max_entries)]:
+            entry_path.unlink(missing_ok=True)
+
+
+index_store = IndexStore(config.index_cache_dir)
@@ -1,5 +1,6 @@
 import json
 import copy
+import html
 import time
 import traceback
 import mistune
@@ -34,13 +35,23 @@ from llama_assistant.global_hotkey import GlobalHotkey
 from llama_assistant.setting_dialog import SettingsDialog
 from llama_assistant.speech_recognition_thread import SpeechRecognitionThread
 from llama_assistant.utils import image_to_base64_data_uri
-from llama_assistant.processing_thread import ProcessingThread, OCRThread
+from llama_assistant.processing_thread import ProcessingThread, OCRThread, ModelPreloadThread
+from llama_assistant.request_scheduler import request_scheduler
+from llama_assistant.model_handler import handler as model_handler
+from llama_assistant.markdown_renderer import IncrementalMarkdownRenderer
 from llama_assistant.ui_manager import UIManager
 from llama_assistant.tray_manager import TrayManager
 from llama_assistant.screen_capture_widget import ScreenCaptureWidget
 from llama_assistant.setting_validator import validate_numeric_field
 from llama_assistant.utils import load_image
 
+# states of the loading animation shown until the first token arrives
+LOADING_IDLE = "idle"
+LOADING_TYPING = "typing"
+LOADING_HOLDING = "holding"
+LOADING_TICK_MS = 50
+LOADING_HOLD_TICKS = 10
+
 
 class LlamaAssistant(QMainWindow):
     def __init__(self):
@@ -59,13 +70,26 @@ class LlamaAssistant(QMainWindow):
         self.current_text_reasoning_model = self.settings.get("text_reasoning_model")
         self.current_multimodal_model = self.settings.get("multimodal_model")
         self.processing_thread = None
+        # cancelled threads are kept referenced until they have unwound
+        self.cancelled_threads = []
+        self.preload_thread = None
+        self.preload_pending = False
         self.markdown_creator = mistune.create_markdown()
+        self.markdown_renderer = IncrementalMarkdownRenderer(self.markdown_creator)
         self.gen_mark_down = True
         self.has_ocr_context = False
+        self.loading_timer = QTimer(self)
+        self.loading_timer.timeout.connect(self.advance_loading_animation)
+        self.loading_state = LOADING_IDLE
+        self.loading_message = ""
+        self.loading_step = 0
         self.ui_manager = UIManager(self)
         self.tray_manager = TrayManager(self)
         self.screen_capture_widget = ScreenCaptureWidget(self)
         self.setup_global_shortcut()
+        self.start_model_preloading()
+        # sessions are saved in the background after a short delay, write the pending ones
+        QApplication.instance().aboutToQuit.connect(model_handler.flush_sessions)
 
         # Add drag-drop move support
         self.setWindowFlags(Qt.WindowType.FramelessWindowHint)
@@ -144,6 +168,9 @@ class LlamaAssistant(QMainWindow):
         self.generation_setting = self.settings.get("generation")
         self.rag_setting = self.settings.get("rag")
         self.reasoning_enabled = self.settings.get("reasoning_enabled")
+        self.performance_setting = self.settings.get("performance")
+        model_handler.configure(self.performance_setting)
+        request_scheduler.configure(self.performance_setting)
 
         # Update model display if UI manager exists
         if hasattr(self, "ui_manager"):
@@ -171,12 +198,19 @@ class LlamaAssistant(QMainWindow):
         if dialog.exec():
             new_settings = dialog.get_settings()
             old_shortcut = self.settings["shortcut"]
-            self.settings.update(new_settings)
+            for key, value in new_settings.items():
+                if isinstance(value, dict) and isinstance(self.settings.get(key), dict):
+                    # keep nested settings that are not exposed in the dialog
+                    self.settings[key] = {**self.settings[key], **value}
+                else:
+                    self.settings[key] = value
             self.save_settings()
             self.load_settings()
             self.ui_manager.update_styles()
             # Refresh action buttons in case they were modified
             self.ui_manager.refresh_action_buttons()
+            # Warm up the newly configured models
+            self.start_model_preloading()
 
             if old_shortcut != self.settings["shortcut"]:
                 msg = QMessageBox()
@@ -200,6 +234,41 @@ class LlamaAssistant(QMainWindow):
                 else:
                     print("User chose to restart later.")
 
+    def start_model_preloading(self):
+        # The text model goes last so it is the most recently used one in the model pool
+        # and is kept if the memory budget cannot fit all preloaded models
+        model_ids = []
+        if self.performance_setting["preload_multimodal_model"]:
+            model_ids.append(self.current_multimodal_model)
+        if self.performance_setting["preload_reasoning_model"]:
+            model_ids.append(self.current_text_reasoning_model)
+        if self.performance_setting["preload_text_model"]:
+            model_ids.append(self.current_text_model)
+        model_ids = [model_id for model_id in model_ids if model_id]
+        if not model_ids:
+            return
+
+        if self.preload_thread is not None and self.preload_thread.isRunning():
+            # restart once the running preload finishes, to pick up the latest settings
+            self.preload_pending = True
+            return
+
+        self.preload_pending = False
+        self.preload_thread = ModelPreloadThread(
+            model_ids, self.generation_setting, self.rag_setting
+        )
+        self.preload_thread.preloader_signal.connect(self.on_preload_progress)
+        self.preload_thread.finished_signal.connect(self.on_preload_finished)
+        self.preload_thread.start()
+
+    def on_preload_progress(self, message):
+        self.ui_manager.input_field.set_model_info(message)
+
+    def on_preload_finished(self):
+        self.ui_manager.update_model_display()
+        if self.preload_pending:
+            self.start_model_preloading()
+
     def restart_application(self):
         QApplication.quit()
         # The application will restart automatically because it is being run from a script
@@ -226,6 +295,7 @@ class LlamaAssistant(QMainWindow):
         print(f"Reasoning is now {'enabled' if self.reasoning_enabled else 'disabled'}.")
 
     def on_ocr_button_clicked(self):
+        self.cancel_processing()
         self.show()
         self.show_chat_box()
         self.screen_capture_widget.hide()
@@ -238,7 +308,7 @@ class LlamaAssistant(QMainWindow):
         )
         self.ui_manager.chat_box.append('<span style="color: #aaa;"><b>AI:</b></span> ')
 
-        self.start_cursor_pos = self.ui_manager.chat_box.textCursor().position()
+        self.mark_response_start()
 
         img_path = config.ocr_tmp_file
         if not img_path.exists():
@@ -297,7 +367,38 @@ class LlamaAssistant(QMainWindow):
             return
         self.process_text(message, self.dropped_files, task, action_prompt)
 
+    def on_escape(self):
+        # the first Esc stops a running response, the next one hides the window
+        if not self.cancel_processing():
+            self.hide()
+
+    def cancel_processing(self) -> bool:
+        """Cancel the running generation, return whether there was one to cancel"""
+        thread = self.processing_thread
+        if (
+            not isinstance(thread, ProcessingThread)
+            or not thread.isRunning()
+            or thread.is_cancelled()
+        ):
+            return False
+
+        thread.cancel()
+        # late updates of the cancelled response must not end up in the next one
+        thread.preloader_signal.disconnect()
+        thread.update_signal.disconnect()
+        thread.finished_signal.disconnect()
+        self.cancelled_threads.append(thread)
+        thread.finished.connect(lambda: self.cancelled_threads.remove(thread))
+
+        if self.loading_state != LOADING_IDLE:
+            # remove the loading message, nothing has been generated yet
+            self.stop_loading_animation()
+            self.clear_text_from_start_pos()
+        self.on_processing_finished()
+        return True
+
     def process_text(self, message, file_paths, task="chat", action_prompt=None):
+        self.cancel_processing()
         if task != "chat":
             self.clear_chat()
         self.show_chat_box()
@@ -318,7 +419,7 @@ class LlamaAssistant(QMainWindow):
         )
         self.ui_manager.chat_box.append(f'<span style="color: #aaa;"><b>AI ({task}):</b></span> ')
 
-        self.start_cursor_pos = self.ui_manager.chat_box.textCursor().position()
+        self.mark_response_start()
 
         self.processing_thread = ProcessingThread(
             self.current_text_model
@@ -329,6 +430,7 @@ class LlamaAssistant(QMainWindow):
             prompt,
             lookup_files=file_paths,
             ocr_img_path=config.ocr_tmp_file if self.has_ocr_context else None,
+            flush_interval_ms=self.performance_setting["stream_flush_interval_ms"],
         )
 
         self.processing_thread.preloader_signal.connect(self.indicate_loading)
@@ -339,6 +441,7 @@ class LlamaAssistant(QMainWindow):
         self.has_ocr_context = False
 
     def process_image_with_prompt(self, image_path, file_paths, prompt):
+        self.cancel_processing()
         self.show_chat_box()
         self.ui_manager.chat_box.append(
             f'<span style="color: #aaa;"><b>You:</b></span> [Uploaded an image: {image_path}]'
@@ -347,7 +450,7 @@ class LlamaAssistant(QMainWindow):
         self.ui_manager.chat_box.append('<span style="color: #aaa;"><b>AI:</b></span> ')
 
         self.ui_manager.chat_box.moveCursor(QTextCursor.MoveOperation.End)
-        self.start_cursor_pos = self.ui_manager.chat_box.textCursor().position()
+        self.mark_response_start()
 
         image = image_to_base64_data_uri(image_path)
         self.processing_thread = ProcessingThread(
@@ -358,6 +461,7 @@ class LlamaAssistant(QMainWindow):
             image=image,
             lookup_files=file_paths,
             ocr_img_path=config.ocr_tmp_file if self.has_ocr_context else None,
+            flush_interval_ms=self.performance_setting["stream_flush_interval_ms"],
         )
         self.processing_thread.preloader_signal.connect(self.indicate_loading)
         self.processing_thread.update_signal.connect(self.update_chat_box)
@@ -366,54 +470,78 @@ class LlamaAssistant(QMainWindow):
 
         self.has_ocr_context = False
 
-    def clear_text_from_start_pos(self):
+    def mark_response_start(self):
+        self.start_cursor_pos = self.ui_manager.chat_box.textCursor().position()
+        # finalized markdown blocks are inserted once, only the text after this is re-rendered
+        self.tail_cursor_pos = self.start_cursor_pos
+        self.markdown_renderer.reset()
+
+    def clear_text_from_start_pos(self, start_pos=None):
         cursor = self.ui_manager.chat_box.textCursor()
-        cursor.setPosition(self.start_cursor_pos)
+        cursor.setPosition(self.start_cursor_pos if start_pos is None else start_pos)
         # Select all text from the start_pos to the end
         cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
         # Remove the selected text
         cursor.removeSelectedText()
 
     def indicate_loading(self, message):
-        while self.processing_thread.is_preloading():
+        self.loading_message = message
+        if self.processing_thread is not None and self.processing_thread.is_preloading():
+            # restart the animation with the new message
+            self.loading_state = LOADING_TYPING
+            self.loading_step = 0
+            if not self.loading_timer.isActive():
+                self.loading_timer.start(LOADING_TICK_MS)
+        else:
+            self.stop_loading_animation()
+
+    def stop_loading_animation(self):
+        self.loading_timer.stop()
+        self.loading_state = LOADING_IDLE
+
+    def advance_loading_animation(self):
+        if self.processing_thread is None or not self.processing_thread.is_preloading():
+            self.stop_loading_animation()
+            return
+
+        if self.loading_state == LOADING_TYPING:
+            # display the characters of the message one by one
+            self.loading_step += 1
             self.clear_text_from_start_pos()
             cursor = self.ui_manager.chat_box.textCursor()
-            # create animation where the characters are displayed one by one
-            for c in message:
-                if c == " ":
-                    cursor.insertText(" ")
-                else:
-                    cursor.insertHtml(f'<span style="color: #aaa;">{c}</span>')
-                QApplication.processEvents()  # Process events to update the UI
-                time.sleep(0.05)
-            time.sleep(0.5)
+            visible_text = html.escape(self.loading_message[: self.loading_step])
+            cursor.insertHtml(f'<span style="color: #aaa;">{visible_text}</span>')
+            if self.loading_step >= len(self.loading_message):
+                self.loading_state = LOADING_HOLDING
+                self.loading_step = 0
+        elif self.loading_state == LOADING_HOLDING:
+            # keep the full message for a moment before starting over
+            self.loading_step += 1
+            if self.loading_step >= LOADING_HOLD_TICKS:
+                self.loading_state = LOADING_TYPING
+                self.loading_step = 0
 
     def update_chat_box(self, text):
+        self.stop_loading_animation()
         self.last_response += text
 
-        formatted_text = ""
         if self.gen_mark_down:
-            markdown_response = self.markdown_creator(self.last_response)
-            markdown_response = markdown_response.replace(
-                "&lt;think&gt;", "<div class='think'>Thinking:<p>"
-            )
-            markdown_response = markdown_response.replace("&lt;/think&gt;", "</div>")
-            # Since cannot change the font size of the h1, h2 tag, we will replace it with h3
-            markdown_response = markdown_response.replace("<h1>", "<h3>").replace("</h1>", "</h3>")
-            markdown_response = markdown_response.replace("<h2>", "<h3>").replace("</h2>", "</h3>")
-            markdown_response += "<div></div>"
-            formatted_text = markdown_response
+            finalized_text, tail_text = self.markdown_renderer.feed(text)
         else:
-            formatted_text = self.last_response.replace("\n", "<br>") + "<div></div>"
+            finalized_text, tail_text = text.replace("\n", "<br>"), ""
 
-        self.clear_text_from_start_pos()
+        self.clear_text_from_start_pos(self.tail_cursor_pos)
         cursor = self.ui_manager.chat_box.textCursor()
-        cursor.insertHtml(formatted_text)
+        if finalized_text:
+            cursor.insertHtml(finalized_text)
+            self.tail_cursor_pos = cursor.position()
+        cursor.insertHtml(tail_text + "<div></div>")
         self.ui_manager.chat_box.verticalScrollBar().setValue(
             self.ui_manager.chat_box.verticalScrollBar().maximum()
         )
 
     def on_processing_finished(self):
+        self.stop_loading_animation()
         self.ui_manager.chat_box.textCursor().movePosition(QTextCursor.MoveOperation.End)
 
     def show_chat_box(self):
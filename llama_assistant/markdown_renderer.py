@@ -0,0 +1,89 @@
+from typing import Callable, Tuple
+
+FENCE_MARKERS = ("```", "~~~")
+
+
+class IncrementalMarkdownRenderer:
+    """
+    Render a streamed markdown response block by block.
+
+    Text is split into blocks at blank lines outside code fences. Blocks that are followed by
+    a new top-level block cannot change anymore, so they are rendered once and returned as
+    finalized HTML. Only the trailing, still open block is re-rendered on every update.
+    """
+
+    def __init__(self, markdown_creator: Callable[[str], str]):
+        self.markdown_creator = markdown_creator
+        self.reset()
+
+    def reset(self):
+        self.pending = ""
+        # whether the pending text starts inside a <think> section
+        self.in_think = False
+
+    def feed(self, text: str) -> Tuple[str, str]:
+        """Append streamed text, return (newly finalized HTML, HTML of the open block)"""
+        self.pending += text
+
+        finalized_html = ""
+        split_pos = self._find_last_block_boundary(self.pending)
+        if split_pos > 0:
+            finalized_text = self.pending[:split_pos]
+            self.pending = self.pending[split_pos:]
+            finalized_html = self._render(finalized_text, self.in_think)
+            self.in_think = self._ends_in_think(finalized_text, self.in_think)
+
+        return finalized_html, self._render(self.pending, self.in_think)
+
+    @staticmethod
+    def _find_last_block_boundary(text: str) -> int:
+        """Position after the last blank line that is followed by a new top-level block"""
+        boundary = 0
+        in_fence = False
+        previous_blank = False
+        pos = 0
+        lines = text.split("\n")
+        # the last line may still be incomplete, never use it to decide a boundary
+        for line in lines[:-1]:
+            stripped = line.strip()
+            is_blank = stripped == ""
+            if (
+                previous_blank
+                and not is_blank
+                and not in_fence
+                and not line[0].isspace()
+                and pos > 0
+            ):
+                boundary = pos
+            if stripped.startswith(FENCE_MARKERS):
+                in_fence = not in_fence
+            previous_blank = is_blank
+            pos += len(line) + 1
+        return boundary
+
+    @staticmethod
+    def _ends_in_think(text: str, in_think: bool) -> bool:
+        open_pos = text.rfind("<think>")
+        close_pos = text.rfind("</think>")
+        if open_pos == -1 and close_pos == -1:
+            return in_think
+        return open_pos > close_pos
+
+    def _render(self, text: str, in_think: bool) -> str:
+        if not text:
+            return ""
+
+        html = self.markdown_creator(text)
+        html = html.replace("&lt;think&gt;", "<div class='think'>Thinking:<p>")
+        html = html.replace("&lt;/think&gt;", "</div>")
+        # Since cannot change the font size of the h1, h2 tag, we will replace it with h3
+        html = html.replace("<h1>", "<h3>").replace("</h1>", "</h3>")
+        html = html.replace("<h2>", "<h3>").replace("</h2>", "</h3>")
+
+        # blocks are rendered separately, so a <think> section spanning several blocks is
+        # reopened and closed around each of them
+        if in_think:
+            html = "<div class='think'><p>" + html
+        if self._ends_in_think(text, in_think):
+            html += "</div>"
+        return html
@@ -1,7 +1,9 @@
-import asyncio
-from typing import List, Dict, Set, Optional, TYPE_CHECKING
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List, Dict, Set, Optional, Tuple, TYPE_CHECKING
 import time
-from threading import Timer
+from threading import Event, Lock, RLock, Thread, Timer
 from llama_cpp import Llama
 from llama_cpp.llama_chat_format import (
     MoondreamChatHandler,
@@ -13,11 +15,19 @@ from huggingface_hub import hf_hub_download
 from tqdm import tqdm
 
 from llama_assistant import config
-from llama_assistant.agent import RAGAgent
+from llama_assistant.agent import ProgressEvent, RAGAgent, TokenEvent
+from llama_assistant.event_loop_runner import EventLoopRunner
+from llama_assistant.prompt_cache import TieredPromptCache
+from llama_assistant.session_store import session_store
 
 if TYPE_CHECKING:
     from llama_assistant.processing_thread import ProcessingThread
 
+IDLE_UNLOAD_SECONDS = 3600
+
+# a session is written once no other turn finished for this long, or when the model is unloaded
+SESSION_SAVE_DELAY_SECONDS = 5
+
 
 class Model:
     def __init__(
@@ -43,9 +53,28 @@ class Model:
 class ModelHandler:
     def __init__(self):
         self.supported_models: List[Model] = []
+        # Resident agents keyed by (model_id, context_len), least recently used first
+        self.loaded_agents: "OrderedDict[Tuple[str, int], Dict]" = OrderedDict()
         self.loaded_agent: Optional[Dict] = None
         self.current_model_id: Optional[str] = None
+        self.performance_setting = config.DEFAULT_SETTINGS["performance"]
+        self.memory_budget_bytes = self.performance_setting["model_pool_memory_mb"] * 1024 * 1024
+        # Last known memory footprint per model id, used to make room before reloading it
+        self.model_size_hints: Dict[str, int] = {}
+        # guards the pool, never held while a model loads
+        self.lock = RLock()
+        # (model_id, context_len) -> result of a load in progress
+        self.loading: Dict[Tuple[str, int], Future] = {}
         self.unload_timer: Optional[Timer] = None
+        # guards the pending session saves, and keeps two writes of a session apart
+        self.session_lock = Lock()
+        self.session_write_lock = Lock()
+
+    def configure(self, performance_setting: Dict):
+        with self.lock:
+            self.performance_setting = performance_setting
+            self.memory_budget_bytes = performance_setting["model_pool_memory_mb"] * 1024 * 1024
+            self._enforce_memory_budget()
 
     def refresh_supported_models(self):
         self.supported_models = [Model(**model_data) for model_data in config.models]
@@ -58,8 +87,9 @@ class ModelHandler:
 
     def remove_supported_model(self, model_id: str):
         self.supported_models = [m for m in self.supported_models if m.model_id != model_id]
-        if self.current_model_id == model_id:
-            self.unload_agent()
+        with self.lock:
+            for key in [key for key in self.loaded_agents if key[0] == model_id]:
+                self._evict(key)
 
     def load_agent(
         self,
@@ -67,24 +97,157 @@ class ModelHandler:
         generation_setting,
         rag_setting: Dict,
         processing_thread: "ProcessingThread",
+        activate: bool = True,
     ) -> Optional[Dict]:
-        self.refresh_supported_models()
-        if self.current_model_id == model_id and self.loaded_agent:
-            if generation_setting["context_len"] == self.loaded_agent["model"].context_params.n_ctx:
-                self.loaded_agent["agent"].update_rag_setting(rag_setting)
-                self.loaded_agent["agent"].update_generation_setting(generation_setting)
-                return self.loaded_agent
+        """Load an agent into the pool, or reuse it if it is already loaded.
+        Preloading passes activate=False so the agent serving the current chat stays active.
+        Callers go through the request scheduler, so only one of them uses an agent at a time."""
+        key = (model_id, generation_setting["context_len"])
+        while True:
+            with self.lock:
+                self.refresh_supported_models()
+                agent_data = self.loaded_agents.get(key)
+                if agent_data:
+                    self._touch(key, activate)
+                    break
+
+                # the pool lock is not held while loading, a second caller waits for the load
+                loading = self.loading.get(key)
+                if loading is None:
+                    model = next((m for m in self.supported_models if m.model_id == model_id), None)
+                    if not model:
+                        print(f"Model with ID {model_id} not found.")
+                        return None
+                    loading = self.loading[key] = Future()
+                    # make room for the model before loading it if we have seen its size before
+                    self._enforce_memory_budget(extra_bytes=self.model_size_hints.get(model_id, 0))
+                    break
+            processing_thread.set_preloading(True, "Waiting for model ....")
+            if loading.result() is None:
+                return None
 
+        if agent_data:
+            # may re-index the documents or load the condense model
+            agent_data["agent"].update_rag_setting(rag_setting)
+            agent_data["agent"].update_generation_setting(generation_setting)
+            self._update_condense_model(agent_data, generation_setting, rag_setting)
+            with self.lock:
+                # the prompt caches may have grown since the last check
+                self._enforce_memory_budget()
+            return agent_data
+
+        agent_data = None
+        try:
+            agent_data = self._create_agent(
+                model, generation_setting, rag_setting, processing_thread
+            )
+        finally:
+            with self.lock:
+                del self.loading[key]
+                if agent_data is not None:
+                    self.loaded_agents[key] = agent_data
+                    self._touch(key, activate)
+                    self._enforce_memory_budget()
+                    self.print_pool_stats()
+            loading.set_result(agent_data)
+        return agent_data
+
+    def _create_agent(
+        self,
+        model: Model,
+        generation_setting: Dict,
+        rag_setting: Dict,
+        processing_thread: "ProcessingThread",
+    ) -> Optional[Dict]:
         processing_thread.set_preloading(True, "Loading model ....")
+        start_time = time.time()
+        loaded_model = self._load_model(model, generation_setting)
+        if loaded_model is None:
+            return None
 
-        # if no model is loaded or different model is loaded, or context_len is different, reinitialize the agent
-        self.unload_agent()  # Unload the current model if any
+        model_id = model.model_id
+        prompt_cache = self._create_prompt_cache(model_id, generation_setting["context_len"])
+        if prompt_cache is not None:
+            loaded_model.set_cache(prompt_cache)
 
-        model = next((m for m in self.supported_models if m.model_id == model_id), None)
+        print("Initializing agent ...")
+
+        agent = RAGAgent(
+            generation_setting,
+            rag_setting,
+            llm=loaded_model,
+        )
+
+        if self.performance_setting["restore_session"]:
+            processing_thread.set_preloading(True, "Restoring session ....")
+            chat_history = session_store.restore(
+                model_id, generation_setting["context_len"], loaded_model
+            )
+            if chat_history is not None:
+                agent.chat_history.load(chat_history)
+
+        # the prompt cache is counted with its current size, see _get_resident_bytes
+        estimated_rss = self._estimate_memory_usage(loaded_model)
+        self.model_size_hints[model_id] = estimated_rss
+        now = time.time()
+        agent_data = {
+            "model_id": model_id,
+            "context_len": generation_setting["context_len"],
+            "model": loaded_model,
+            "agent": agent,
+            "generation_setting": generation_setting,
+            "rag_setting": rag_setting,
+            "load_time": now - start_time,
+            "last_used": now,
+            "estimated_rss": estimated_rss,
+            "prompt_cache": prompt_cache,
+            "loop_runner": EventLoopRunner(f"agent-loop-{model_id}"),
+            "condense_model_id": "",
+            "failed_condense_model_id": "",
+            "session_timer": None,
+            "session_dirty": False,
+        }
+        self._update_condense_model(agent_data, generation_setting, rag_setting)
+        return agent_data
+
+    def _update_condense_model(self, agent_data: Dict, generation_setting: Dict, rag_setting: Dict):
+        """Load the draft model the agent condenses queries with, if one is configured.
+        It is owned by the agent, so it is only used by one request at a time."""
+        condense_model_id = rag_setting["condense_model"]
+        if condense_model_id == agent_data["model_id"]:
+            condense_model_id = ""
+        if condense_model_id in (
+            agent_data["condense_model_id"],
+            agent_data["failed_condense_model_id"],
+        ):
+            return
+
+        agent = agent_data["agent"]
+        if agent.condense_llm is not None:
+            agent_data["estimated_rss"] -= self._estimate_memory_usage(agent.condense_llm)
+            agent.condense_llm = None
+        agent_data["condense_model_id"] = ""
+        agent_data["failed_condense_model_id"] = ""
+        if not condense_model_id:
+            return
+
+        model = next((m for m in self.supported_models if m.model_id == condense_model_id), None)
         if not model:
-            print(f"Model with ID {model_id} not found.")
-            return None
+            print(f"Condense model with ID {condense_model_id} not found.")
+            # not looked up again until the setting changes
+            agent_data["failed_condense_model_id"] = condense_model_id
+            return
+
+        print(f"Loading condense model: {condense_model_id}")
+        condense_llm = self._load_model(model, generation_setting)
+        if condense_llm is None:
+            agent_data["failed_condense_model_id"] = condense_model_id
+            return
+        agent.condense_llm = condense_llm
+        agent_data["condense_model_id"] = condense_model_id
+        agent_data["estimated_rss"] += self._estimate_memory_usage(condense_llm)
 
+    def _load_model(self, model: Model, generation_setting: Dict) -> Optional[Llama]:
         if model.is_online():
             if model.model_type == "text" or model.model_type == "text-reasoning":
                 print("load online model")
@@ -181,43 +344,192 @@ class ModelHandler:
             print("load local model")
             loaded_model = Llama(model_path=model.model_path)
 
-        print("Initializing agent ...")
+        return loaded_model
 
-        agent = RAGAgent(
-            generation_setting,
-            rag_setting,
-            llm=loaded_model,
+    def _create_prompt_cache(self, model_id: str, context_len: int) -> Optional[TieredPromptCache]:
+        """Cache evaluated prompt prefixes, so each chat turn only evaluates the new tokens"""
+        ram_capacity_mb = self.performance_setting["prompt_cache_ram_mb"]
+        if ram_capacity_mb <= 0:
+            return None
+
+        disk_cache_dir = None
+        if self.performance_setting["prompt_cache_disk_enabled"]:
+            cache_name = f"{model_id.replace('/', '__')}-{context_len}"
+            disk_cache_dir = config.prompt_cache_dir / cache_name
+
+        return TieredPromptCache(
+            ram_capacity_bytes=ram_capacity_mb * 1024 * 1024,
+            disk_cache_dir=disk_cache_dir,
+            disk_capacity_bytes=self.performance_setting["prompt_cache_disk_mb"] * 1024 * 1024,
         )
 
-        self.loaded_agent = {
-            "model": loaded_model,
-            "agent": agent,
-            "generation_setting": generation_setting,
-            "rag_setting": rag_setting,
-            "last_used": time.time(),
-        }
-        self.current_model_id = model_id
+    def _estimate_memory_usage(self, loaded_model: Llama) -> int:
+        """Estimate the resident size of a model: weights file plus an f16 KV cache"""
+        try:
+            weights_size = os.path.getsize(loaded_model.model_path)
+        except OSError:
+            weights_size = 0
+
+        metadata = loaded_model.metadata
+        arch = metadata.get("general.architecture", "")
+
+        def get_int(name: str, default: int) -> int:
+            # per-layer values are arrays, which the metadata only gives as a description
+            try:
+                return int(metadata.get(f"{arch}.{name}", default))
+            except ValueError:
+                return default
+
+        n_embd = loaded_model.n_embd()
+        n_layer = get_int("block_count", 0)
+        n_head = get_int("attention.head_count", 1) or 1
+        # with grouped-query attention several query heads share one key/value head
+        n_head_kv = get_int("attention.head_count_kv", n_head)
+        key_length = get_int("attention.key_length", n_embd // n_head)
+        value_length = get_int("attention.value_length", key_length)
+        kv_cache_size = 2 * n_layer * loaded_model.n_ctx() * n_head_kv * (key_length + value_length)
+
+        return weights_size + kv_cache_size
+
+    @staticmethod
+    def _get_resident_bytes(agent_data: Dict) -> int:
+        """Estimated size of the models plus what the prompt cache currently holds in RAM"""
+        prompt_cache = agent_data["prompt_cache"]
+        cache_size = prompt_cache.cache_size if prompt_cache is not None else 0
+        return agent_data["estimated_rss"] + cache_size
+
+    def _touch(self, key: Tuple[str, int], activate: bool = True):
+        self.loaded_agents.move_to_end(key)
+        self.loaded_agents[key]["last_used"] = time.time()
+        if activate:
+            self.loaded_agent = self.loaded_agents[key]
+            self.current_model_id = key[0]
         self._schedule_unload()
 
-        return self.loaded_agent
-
-    def unload_agent(self):
-        if self.loaded_agent:
-            print(f"Unloading model: {self.current_model_id}")
+    def _evict(self, key: Tuple[str, int]):
+        agent_data = self.loaded_agents.pop(key)
+        print(f"Unloading model: {key[0]} (context length {key[1]})")
+        # a query may still be running on the evicted agent, the loop stops once it is done
+        agent_data["loop_runner"].stop()
+        # the snapshot keeps the model alive until it is written
+        Thread(target=self.flush_session, args=(agent_data,)).start()
+        if self.loaded_agent is agent_data:
             self.loaded_agent = None
             self.current_model_id = None
-        if self.unload_timer:
-            self.unload_timer.cancel()
-            self.unload_timer = None
+        self.print_pool_stats()
+
+    def _enforce_memory_budget(self, extra_bytes: int = 0):
+        """Evict least recently used agents until the pool fits in the memory budget.
+        When making room for a model about to be loaded (extra_bytes > 0) any agent can be
+        evicted, otherwise the active and the most recently used agents are always kept."""
+        keep = []
+        if extra_bytes == 0 and self.loaded_agents:
+            keep = [self.loaded_agent, self.loaded_agents[next(reversed(self.loaded_agents))]]
+
+        for key in list(self.loaded_agents):
+            total_bytes = extra_bytes + sum(
+                self._get_resident_bytes(agent_data) for agent_data in self.loaded_agents.values()
+            )
+            if total_bytes <= self.memory_budget_bytes:
+                break
+            if any(self.loaded_agents[key] is agent_data for agent_data in keep):
+                continue
+            self._evict(key)
+
+    def get_pool_stats(self) -> List[Dict]:
+        """Report the resident agents, least recently used first"""
+        return [
+            {
+                "model_id": model_id,
+                "context_len": context_len,
+                "load_time": agent_data["load_time"],
+                "last_used": agent_data["last_used"],
+                "estimated_rss": self._get_resident_bytes(agent_data),
+            }
+            for (model_id, context_len), agent_data in list(self.loaded_agents.items())
+        ]
+
+    def print_pool_stats(self):
+        now = time.time()
+        pool_stats = self.get_pool_stats()
+        total_mb = sum(stats["estimated_rss"] for stats in pool_stats) / 1024 / 1024
+        print(
+            f"Model pool: {len(pool_stats)} models, ~{total_mb:.0f} MB of "
+            f"{self.memory_budget_bytes / 1024 / 1024:.0f} MB"
+        )
+        for stats in pool_stats:
+            print(
+                f"  {stats['model_id']} (context length {stats['context_len']}): "
+                f"~{stats['estimated_rss'] / 1024 / 1024:.0f} MB, "
+                f"loaded in {stats['load_time']:.1f}s, "
+                f"last used {now - stats['last_used']:.0f}s ago"
+            )
+
+    def unload_agent(self):
+        with self.lock:
+            for key in list(self.loaded_agents):
+                self._evict(key)
+            if self.unload_timer:
+                self.unload_timer.cancel()
+                self.unload_timer = None
+
+    def unload_idle_agents(self):
+        with self.lock:
+            now = time.time()
+            for key, agent_data in list(self.loaded_agents.items()):
+                if now - agent_data["last_used"] >= IDLE_UNLOAD_SECONDS:
+                    self._evict(key)
+            if self.loaded_agents:
+                self._schedule_unload()
 
     async def run_agent(
-        self, agent: RAGAgent, message: str, lookup_files: Set, image: str, stream: bool
+        self,
+        agent: RAGAgent,
+        message: str,
+        lookup_files: Set,
+        image: str,
+        stream: bool,
+        cancel_event: Optional[Event] = None,
     ):
         response = await agent.run(
-            query_str=message, lookup_files=lookup_files, image=image, streaming=stream
+            query_str=message,
+            lookup_files=lookup_files,
+            image=image,
+            streaming=stream,
+            cancel_event=cancel_event,
         )
         return response
 
+    async def stream_agent(
+        self,
+        agent: RAGAgent,
+        message: str,
+        lookup_files: Set,
+        image: str,
+        cancel_event: Optional[Event],
+        processing_thread: "ProcessingThread",
+    ):
+        """Run the agent, forward its progress to the processing thread and yield the
+        completion chunks as they are decoded"""
+        handler = agent.run(
+            query_str=message,
+            lookup_files=lookup_files,
+            image=image,
+            streaming=True,
+            cancel_event=cancel_event,
+        )
+        try:
+            async for event in handler.stream_events():
+                if isinstance(event, TokenEvent):
+                    yield event.chunk
+                elif isinstance(event, ProgressEvent):
+                    processing_thread.set_preloading(event.loading, event.message)
+            # raise the exception of a failed run
+            await handler
+        finally:
+            if not handler.done():
+                await handler.cancel_run()
+
     def chat_completion(
         self,
         model_id: str,
@@ -228,23 +540,32 @@ class ModelHandler:
         lookup_files: Optional[Set[str]] = None,
         stream: bool = False,
         processing_thread: "ProcessingThread" = None,
+        cancel_event: Optional[Event] = None,
     ) -> str:
+        """
+        Run a query against the model. Setting cancel_event stops decoding at the next token; the
+        model stays loaded and its KV cache keeps the evaluated prefix for the next request.
+        """
         agent_data = self.load_agent(model_id, generation_setting, rag_setting, processing_thread)
-        agent = agent_data.get("agent")
         if not agent_data:
             return "Failed to load model"
-
-        agent_data["last_used"] = time.time()
-        self._schedule_unload()
+        # requests to other models may activate another agent while this one runs, the turn is
+        # added to the history of the agent that answered it
+        processing_thread.agent_data = agent_data
+        agent = agent_data.get("agent")
 
         processing_thread.set_preloading(True, "Thinking ....")
-        try:
-            loop = asyncio.get_running_loop()
-            response = loop.run_until_complete(
-                self.run_agent(agent, message, lookup_files, image, stream)
+        if stream:
+            # the workflow only starts once the caller iterates over the chunks
+            return agent_data["loop_runner"].iterate(
+                self.stream_agent(
+                    agent, message, lookup_files, image, cancel_event, processing_thread
+                )
             )
-        except RuntimeError:  # no running event loop
-            response = asyncio.run(self.run_agent(agent, message, lookup_files, image, stream))
+
+        response = agent_data["loop_runner"].run(
+            self.run_agent(agent, message, lookup_files, image, stream, cancel_event)
+        )
 
         processing_thread.set_preloading(False, "Thinking done.")
 
@@ -258,16 +579,23 @@ class ModelHandler:
         agent = self.loaded_agent.get("agent")
         if agent:
             agent.chat_history.add_message({"role": role, "content": message})
+            agent.chat_history.summarize_if_needed()
 
     def add_conversation_turn(
-        self, user_message: str, assistant_response: str, image: Optional[str] = None
+        self,
+        user_message: str,
+        assistant_response: str,
+        image: Optional[str] = None,
+        agent_data: Optional[Dict] = None,
     ):
-        """Add both user message and assistant response to chat history together"""
-        if self.loaded_agent is None:
+        """Add both user message and assistant response to chat history together.
+        agent_data is the agent that answered, the active agent by default."""
+        agent_data = agent_data or self.loaded_agent
+        if agent_data is None:
             print("Agent has not been initialized. Cannot update chat history.")
             return
 
-        agent = self.loaded_agent.get("agent")
+        agent = agent_data.get("agent")
         if agent:
             # Format user message
             if image:
@@ -286,17 +614,82 @@ class ModelHandler:
 
             # Add both as a conversation turn
             agent.chat_history.add_conversation_turn(user_msg, assistant_msg)
+            self.save_session(agent_data)
+            agent.chat_history.summarize_if_needed()
+
+    def save_session(self, agent_data: Optional[Dict] = None):
+        """Snapshot the KV state and chat history of a model to disk, the active one by
+        default. The snapshot is written in the background once no other turn finished for
+        SESSION_SAVE_DELAY_SECONDS, so the next request does not wait for the disk."""
+        agent_data = agent_data or self.loaded_agent
+        if agent_data is None or not self.performance_setting["restore_session"]:
+            return
+
+        with self.session_lock:
+            agent_data["session_dirty"] = True
+            if agent_data["session_timer"]:
+                agent_data["session_timer"].cancel()
+            agent_data["session_timer"] = Timer(
+                SESSION_SAVE_DELAY_SECONDS, self._write_session, args=(agent_data,)
+            )
+            agent_data["session_timer"].daemon = True
+            agent_data["session_timer"].start()
+
+    def flush_session(self, agent_data: Dict):
+        """Write a pending snapshot now"""
+        with self.session_lock:
+            if agent_data["session_timer"]:
+                agent_data["session_timer"].cancel()
+                agent_data["session_timer"] = None
+        self._write_session(agent_data)
+
+    def flush_sessions(self):
+        """Write the pending snapshots of all loaded models, e.g. before quitting"""
+        for agent_data in list(self.loaded_agents.values()):
+            self.flush_session(agent_data)
+
+    def _write_session(self, agent_data: Dict):
+        with self.session_lock:
+            if not agent_data["session_dirty"]:
+                return
+            agent_data["session_dirty"] = False
+
+        start_time = time.time()
+        try:
+            with self.session_write_lock:
+                # only copying the state needs the model, writing it does not block requests
+                with agent_data["agent"].llm_lock:
+                    state = session_store.snapshot(agent_data["model"])
+                    chat_history = list(agent_data["agent"].chat_history.get_chat_history())
+                session_store.save(
+                    agent_data["model_id"],
+                    agent_data["context_len"],
+                    agent_data["model"],
+                    state,
+                    chat_history,
+                )
+        except Exception as e:
+            print(f"Failed to save session of {agent_data['model_id']}: {e}")
+            return
+        print(
+            f"Saved session of {agent_data['model_id']} ({state.n_tokens} tokens) "
+            f"in {time.time() - start_time:.2f}s"
+        )
 
     def clear_chat_history(self):
-        agent = self.loaded_agent.get("agent")
-        if agent:
-            agent.chat_history.clear()
+        for agent_data in list(self.loaded_agents.values()):
+            agent_data["agent"].chat_history.clear()
+            if self.performance_setting["restore_session"]:
+                session_store.save_chat_history(
+                    agent_data["model_id"], agent_data["context_len"], agent_data["model"], []
+                )
 
     def _schedule_unload(self):
         if self.unload_timer:
             self.unload_timer.cancel()
 
-        self.unload_timer = Timer(3600, self.unload_agent)
+        self.unload_timer = Timer(IDLE_UNLOAD_SECONDS, self.unload_idle_agents)
+        self.unload_timer.daemon = True
         self.unload_timer.start()
 
 
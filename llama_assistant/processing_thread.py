@@ -1,10 +1,77 @@
-from typing import Set, Optional, Dict
+import time
+from threading import Condition, Event, Thread
+from typing import List, Set, Optional, Dict
 from PyQt6.QtCore import (
     QThread,
     pyqtSignal,
 )
 from llama_assistant.model_handler import handler as model_handler
 from llama_assistant.ocr_engine import ocr_engine
+from llama_assistant.request_scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    ScheduledRequest,
+    request_scheduler,
+)
+
+# flush buffered deltas early once they reach this many characters
+MAX_BUFFERED_CHARS = 512
+
+
+class TokenCoalescer:
+    """Buffer streamed deltas and emit them at most once per flush interval, so fast models
+    are not slowed down by one cross-thread signal and one chat box update per token.
+    A flusher thread emits buffered deltas once the interval has passed, so text does not
+    wait for the next token while decoding pauses."""
+
+    def __init__(self, emit, flush_interval_ms: int):
+        self.emit = emit
+        self.flush_interval = flush_interval_ms / 1000
+        self.buffer = []
+        self.buffered_chars = 0
+        self.last_flush_time = 0.0
+        self.closed = False
+        self.condition = Condition()
+        self.flusher = Thread(target=self._run_flusher, daemon=True)
+        self.flusher.start()
+
+    def add(self, delta: str):
+        with self.condition:
+            self.buffer.append(delta)
+            self.buffered_chars += len(delta)
+            if (
+                time.monotonic() - self.last_flush_time >= self.flush_interval
+                or self.buffered_chars >= MAX_BUFFERED_CHARS
+            ):
+                self._flush()
+            else:
+                self.condition.notify()
+
+    def _run_flusher(self):
+        with self.condition:
+            while not self.closed:
+                if not self.buffer:
+                    self.condition.wait()
+                    continue
+                remaining = self.last_flush_time + self.flush_interval - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                else:
+                    self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.emit("".join(self.buffer))
+            self.buffer = []
+            self.buffered_chars = 0
+        self.last_flush_time = time.monotonic()
+
+    def close(self):
+        """Emit what is left and stop the flusher thread"""
+        with self.condition:
+            self._flush()
+            self.closed = True
+            self.condition.notify()
 
 
 class ProcessingThread(QThread):
@@ -21,6 +88,8 @@ class ProcessingThread(QThread):
         lookup_files: Optional[Set[str]] = None,
         image: str = None,
         ocr_img_path: str = None,
+        flush_interval_ms: int = 33,
+        priority: int = PRIORITY_INTERACTIVE,
     ):
         super().__init__()
         self.model = model
@@ -31,8 +100,40 @@ class ProcessingThread(QThread):
         self.lookup_files = lookup_files
         self.preloading = False
         self.ocr_img_path = ocr_img_path
+        self.flush_interval_ms = flush_interval_ms
+        self.priority = priority
+        self.cancel_event = Event()
+        # pool entry of the model that served the request, set by chat_completion
+        self.agent_data: Optional[Dict] = None
+
+    def cancel(self):
+        """Stop the running generation, it ends at the next decoded token"""
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
 
     def run(self):
+        # the model is not thread-safe, the scheduler runs one request per model at a time
+        request = request_scheduler.submit(self.model, self.priority)
+        if request is None:
+            self.update_signal.emit("Too many requests are waiting, please try again later.")
+            self.finished_signal.emit()
+            return
+
+        if not request_scheduler.is_next(request):
+            self.set_preloading(True, "Waiting for the previous request ....")
+        if not request_scheduler.wait_for_turn(request, self.cancel_event):
+            self.set_preloading(False, "Cancelled.")
+            self.finished_signal.emit()
+            return
+
+        try:
+            self._run(request)
+        finally:
+            request_scheduler.finish(request, cancelled=self.is_cancelled())
+
+    def _run(self, request: ScheduledRequest):
         if self.ocr_img_path:
             self.set_preloading(True, "Thinking ....")
             ocr_output = ocr_engine.perform_ocr(self.ocr_img_path, streaming=False)
@@ -40,6 +141,11 @@ class ProcessingThread(QThread):
             self.prompt = ocr_output + self.prompt
             print("Prompt with OCR context:", self.prompt)
 
+        if self.is_cancelled():
+            self.set_preloading(False, "Cancelled.")
+            self.finished_signal.emit()
+            return
+
         output = model_handler.chat_completion(
             self.model,
             self.generation_setting,
@@ -49,19 +155,40 @@ class ProcessingThread(QThread):
             lookup_files=self.lookup_files,
             stream=True,
             processing_thread=self,
+            cancel_event=self.cancel_event,
         )
         full_response_str = ""
-        for chunk in output:
-            delta = chunk["choices"][0]["delta"]
-            if "role" in delta:
-                print(delta["role"], end=": ")
-            elif "content" in delta:
-                print(delta["content"], end="")
-                full_response_str += delta["content"]
-                self.update_signal.emit(delta["content"])
-
-        # Add both user message and assistant response to history together
-        model_handler.add_conversation_turn(self.prompt, full_response_str, self.image)
+        coalescer = TokenCoalescer(self.update_signal.emit, self.flush_interval_ms)
+        try:
+            for chunk in output:
+                if self.is_cancelled():
+                    # closing the generator lets llama.cpp finish the completion without
+                    # decoding further, the model stays loaded for the next request
+                    if hasattr(output, "close"):
+                        output.close()
+                    break
+                delta = chunk["choices"][0]["delta"]
+                if "role" in delta:
+                    print(delta["role"], end=": ")
+                elif "content" in delta:
+                    request.mark_token()
+                    print(delta["content"], end="")
+                    full_response_str += delta["content"]
+                    coalescer.add(delta["content"])
+        finally:
+            coalescer.close()
+
+        if self.is_cancelled():
+            print("\nGeneration cancelled")
+            if not full_response_str:
+                self.finished_signal.emit()
+                return
+
+        # Add both user message and assistant response to history together, a cancelled response
+        # is kept up to where it stopped
+        model_handler.add_conversation_turn(
+            self.prompt, full_response_str, self.image, agent_data=self.agent_data
+        )
         self.finished_signal.emit()
 
     def clear_chat_history(self):
@@ -79,6 +206,55 @@ class ProcessingThread(QThread):
         return self.preloading
 
 
+class ModelPreloadThread(QThread):
+    """Load models into the model pool in the background so the first query hits a warm model"""
+
+    preloader_signal = pyqtSignal(str)
+    finished_signal = pyqtSignal()
+
+    def __init__(self, model_ids: List[str], generation_setting: Dict, rag_setting: Dict):
+        super().__init__()
+        self.model_ids = model_ids
+        self.generation_setting = generation_setting
+        self.rag_setting = rag_setting
+        self.preloading = False
+
+    def run(self):
+        for idx, model_id in enumerate(self.model_ids):
+            self.set_preloading(True, f"Preloading model {idx + 1}/{len(self.model_ids)} ....")
+            # scheduled like a query, updating the settings of a loaded agent may re-index the
+            # documents of a running request
+            request = request_scheduler.submit(model_id, PRIORITY_BACKGROUND)
+            if request is None:
+                continue
+            request_scheduler.wait_for_turn(request)
+            try:
+                model_handler.load_agent(
+                    model_id,
+                    self.generation_setting,
+                    self.rag_setting,
+                    processing_thread=self,
+                    activate=False,
+                )
+            except Exception as e:
+                print(f"Failed to preload model {model_id}: {e}")
+            finally:
+                request_scheduler.finish(request)
+
+        self.set_preloading(False, "Models ready.")
+        self.finished_signal.emit()
+
+    def emit_preloading_message(self, message: str):
+        self.preloader_signal.emit(message)
+
+    def set_preloading(self, preloading: bool, message: str):
+        self.preloading = preloading
+        self.emit_preloading_message(message)
+
+    def is_preloading(self):
+        return self.preloading
+
+
 class OCRThread(QThread):
     preloader_signal = pyqtSignal(str)
     update_signal = pyqtSignal(str)
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Sequence, Tuple
+
+from llama_cpp.llama import LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache
+
+try:
+    from llama_cpp.llama_cache import LlamaDiskCache
+    import diskcache  # noqa: F401 - LlamaDiskCache needs it at construction time
+except ImportError:
+    LlamaDiskCache = None
+
+
+class TieredPromptCache(BaseLlamaCache):
+    """
+    Prompt state cache for llama.cpp with a RAM tier and an optional disk tier.
+
+    llama-cpp-python looks up the longest cached prefix of every prompt and restores its KV
+    state, so only the tokens after the prefix (usually the new user turn) are evaluated.
+    States evicted from RAM are demoted to disk when the disk tier is enabled.
+    """
+
+    def __init__(
+        self,
+        ram_capacity_bytes: int,
+        disk_cache_dir: Optional[Path] = None,
+        disk_capacity_bytes: int = 0,
+    ):
+        super().__init__(capacity_bytes=ram_capacity_bytes)
+        self.ram_cache: "OrderedDict[Tuple[int, ...], LlamaState]" = OrderedDict()
+        self.disk_cache = None
+        if disk_cache_dir is not None:
+            if LlamaDiskCache is None:
+                print("diskcache is not installed, the prompt cache will only use RAM")
+            else:
+                self.disk_cache = LlamaDiskCache(
+                    cache_dir=str(disk_cache_dir), capacity_bytes=disk_capacity_bytes
+                )
+
+    @property
+    def cache_size(self) -> int:
+        # the states also hold a copy of the logits buffer. Copied first, since the model pool
+        # reads the size while a request may be adding states
+        return sum(
+            state.llama_state_size + state.scores.nbytes for state in list(self.ram_cache.values())
+        )
+
+    def _find_longest_ram_prefix_key(self, key: Tuple[int, ...]) -> Optional[Tuple[int, ...]]:
+        best_len = 0
+        best_key = None
+        for k in self.ram_cache.keys():
+            prefix_len = self._longest_token_prefix(k, key)
+            if prefix_len > best_len:
+                best_len = prefix_len
+                best_key = k
+        return best_key
+
+    @staticmethod
+    def _longest_token_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+        prefix_len = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            prefix_len += 1
+        return prefix_len
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        key = tuple(key)
+        ram_key = self._find_longest_ram_prefix_key(key)
+        ram_prefix_len = self._longest_token_prefix(ram_key, key) if ram_key else 0
+
+        if self.disk_cache is not None:
+            disk_key = self.disk_cache._find_longest_prefix_key(key)
+            if disk_key is not None and self._longest_token_prefix(disk_key, key) > ram_prefix_len:
+                # promote the state to RAM, it is likely to be used again in the next turn
+                value = self.disk_cache[disk_key]
+                self[disk_key] = value
+                return value
+
+        if ram_key is None:
+            raise KeyError("Key not found")
+        self.ram_cache.move_to_end(ram_key)
+        return self.ram_cache[ram_key]
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        key = tuple(key)
+        if self._find_longest_ram_prefix_key(key) is not None:
+            return True
+        return self.disk_cache is not None and key in self.disk_cache
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState):
+        key = tuple(key)
+        if key in self.ram_cache:
+            del self.ram_cache[key]
+        self.ram_cache[key] = value
+        while self.cache_size > self.capacity_bytes and len(self.ram_cache) > 0:
+            evicted_key, evicted_value = self.ram_cache.popitem(last=False)
+            if self.disk_cache is not None:
+                self.disk_cache[evicted_key] = evicted_value
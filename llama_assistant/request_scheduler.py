@@ -0,0 +1,205 @@
+import heapq
+import itertools
+import time
+from collections import deque
+from threading import Condition, Event
+from typing import Deque, Dict, List, Optional, Tuple
+
+# requests with a lower priority value run first
+PRIORITY_INTERACTIVE = 0
+# model preloading, which only has to happen before the next query
+PRIORITY_BACKGROUND = 10
+
+# how often a queued request checks whether it was cancelled
+CANCEL_POLL_INTERVAL = 0.1
+# number of finished requests kept for the latency statistics
+METRICS_WINDOW = 100
+# the latency percentiles are printed every this many finished requests
+STATS_INTERVAL = 10
+
+
+class ScheduledRequest:
+    """A request waiting for or running on a model, with its latency measurements"""
+
+    def __init__(self, request_id: int, model_id: str, priority: int):
+        self.request_id = request_id
+        self.model_id = model_id
+        self.priority = priority
+        self.status = "queued"  # queued, running, done or cancelled
+        self.submit_time = time.monotonic()
+        self.start_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        self.num_chunks = 0
+
+    def mark_token(self):
+        if self.first_token_time is None:
+            self.first_token_time = time.monotonic()
+        self.num_chunks += 1
+
+    @property
+    def queue_wait(self) -> Optional[float]:
+        if self.start_time is None:
+            return None
+        return self.start_time - self.submit_time
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.submit_time
+
+    @property
+    def total_time(self) -> Optional[float]:
+        if self.end_time is None:
+            return None
+        return self.end_time - self.submit_time
+
+
+class RequestScheduler:
+    """
+    Gate requests in front of the models: requests to the same model run one at a time in
+    priority order (FIFO within a priority), requests to different models run concurrently.
+    The number of queued requests is bounded, further submissions are rejected.
+    """
+
+    def __init__(self, max_queued_requests: int = 4):
+        self.max_queued_requests = max_queued_requests
+        self.condition = Condition()
+        self.pending: List[Tuple[int, int, ScheduledRequest]] = []
+        self.running: Dict[str, ScheduledRequest] = {}
+        self.request_ids = itertools.count(1)
+        self.finished: Deque[ScheduledRequest] = deque(maxlen=METRICS_WINDOW)
+        self.num_rejected = 0
+        self.num_finished = 0
+
+    def configure(self, performance_setting: Dict):
+        with self.condition:
+            self.max_queued_requests = performance_setting["max_queued_requests"]
+
+    def submit(
+        self, model_id: str, priority: int = PRIORITY_INTERACTIVE
+    ) -> Optional[ScheduledRequest]:
+        """Queue a request, return None if the queue is full"""
+        with self.condition:
+            if len(self.pending) >= self.max_queued_requests:
+                self.num_rejected += 1
+                print(f"Request queue is full, rejecting request for {model_id}")
+                return None
+            request_id = next(self.request_ids)
+            request = ScheduledRequest(request_id, model_id, priority)
+            heapq.heappush(self.pending, (priority, request_id, request))
+            return request
+
+    def is_next(self, request: ScheduledRequest) -> bool:
+        """Whether the request can start right away"""
+        with self.condition:
+            return self._can_start(request)
+
+    def _can_start(self, request: ScheduledRequest) -> bool:
+        if request.model_id in self.running:
+            return False
+        # the heap is only partially ordered, look for the first request of this model
+        first = min(
+            (entry for entry in self.pending if entry[2].model_id == request.model_id),
+            default=None,
+        )
+        return first is not None and first[2] is request
+
+    def wait_for_turn(
+        self, request: ScheduledRequest, cancel_event: Optional[Event] = None
+    ) -> bool:
+        """Block until the request may run. Return False if it was cancelled while queued."""
+        with self.condition:
+            while not self._can_start(request):
+                if cancel_event is not None and cancel_event.is_set():
+                    self._remove_pending(request)
+                    request.status = "cancelled"
+                    request.end_time = time.monotonic()
+                    self.finished.append(request)
+                    self.condition.notify_all()
+                    return False
+                self.condition.wait(timeout=CANCEL_POLL_INTERVAL)
+
+            self._remove_pending(request)
+            self.running[request.model_id] = request
+            request.status = "running"
+            request.start_time = time.monotonic()
+            return True
+
+    def _remove_pending(self, request: ScheduledRequest):
+        self.pending = [entry for entry in self.pending if entry[2] is not request]
+        heapq.heapify(self.pending)
+
+    def finish(self, request: ScheduledRequest, cancelled: bool = False):
+        with self.condition:
+            if self.running.get(request.model_id) is request:
+                del self.running[request.model_id]
+            request.status = "cancelled" if cancelled else "done"
+            request.end_time = time.monotonic()
+            self.condition.notify_all()
+            if request.priority >= PRIORITY_BACKGROUND:
+                # preloading would skew the latencies of the queries
+                return
+            self.finished.append(request)
+            self.num_finished += 1
+            print_stats = self.num_finished % STATS_INTERVAL == 0
+
+        ttft = request.time_to_first_token
+        print(
+            f"Request {request.request_id} ({request.model_id}) {request.status}: "
+            f"queue wait {request.queue_wait:.2f}s, "
+            f"first token {'-' if ttft is None else f'{ttft:.2f}s'}, "
+            f"total {request.total_time:.2f}s, {request.num_chunks} chunks"
+        )
+        if print_stats:
+            self.print_stats()
+
+    def get_stats(self) -> Dict:
+        """Queue state and latency percentiles of the recently finished requests"""
+        with self.condition:
+            finished = list(self.finished)
+            stats = {
+                "queued": len(self.pending),
+                "running": len(self.running),
+                "rejected": self.num_rejected,
+                "finished": len(finished),
+                "cancelled": sum(request.status == "cancelled" for request in finished),
+            }
+
+        for name in ("queue_wait", "time_to_first_token", "total_time"):
+            values = sorted(
+                getattr(request, name) for request in finished if getattr(request, name) is not None
+            )
+            stats[f"{name}_p50"] = _percentile(values, 0.5)
+            stats[f"{name}_p95"] = _percentile(values, 0.95)
+        return stats
+
+    def print_stats(self):
+        stats = self.get_stats()
+
+        def format_seconds(value: Optional[float]) -> str:
+            return "-" if value is None else f"{value:.2f}s"
+
+        print(
+            f"Last {stats['finished']} requests ({stats['cancelled']} cancelled, "
+            f"{stats['rejected']} rejected in total): "
+            + ", ".join(
+                f"{label} p50 {format_seconds(stats[f'{name}_p50'])} "
+                f"p95 {format_seconds(stats[f'{name}_p95'])}"
+                for name, label in (
+                    ("queue_wait", "queue wait"),
+                    ("time_to_first_token", "first token"),
+                    ("total_time", "total"),
+                )
+            )
+        )
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+request_scheduler = RequestScheduler()
@@ -0,0 +1,109 @@
+import time
+from threading import Lock, Thread
+from typing import Dict, List, Optional
+
+from llama_index.core.schema import MetadataMode, NodeWithScore
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:
+    CrossEncoder = None
+
+_rerankers: Dict[str, "Reranker"] = {}
+_rerankers_lock = Lock()
+_warned_not_installed = False
+
+
+class Reranker:
+    """
+    Cross-encoder that scores (query, chunk) pairs jointly, which ranks chunks more accurately
+    than comparing their embeddings. Runs on the CPU so that it does not compete with the LLM
+    for GPU memory.
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        print(f"Loading reranker model {model_name}...")
+        self.model = CrossEncoder(model_name, device="cpu")
+        # predict is not safe to call from several threads at once
+        self.lock = Lock()
+        # measured scoring time per chunk, unknown until the first batch has run
+        self.seconds_per_pair: Optional[float] = None
+
+    def rerank(
+        self,
+        query_str: str,
+        nodes: List[NodeWithScore],
+        top_k: int,
+        batch_size: int,
+        budget_ms: int,
+    ) -> List[NodeWithScore]:
+        """Return the top_k nodes by cross-encoder score. If scoring all nodes would exceed the
+        time budget, the nodes are returned in their retrieval order instead. Batches shrink
+        as the deadline nears, so that the last one does not run past it."""
+        start_time = time.time()
+        deadline = start_time + budget_ms / 1000
+        texts = [node.node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        scores: List[float] = []
+        with self.lock:
+            while len(scores) < len(texts):
+                remaining = deadline - time.time()
+                if self.seconds_per_pair is None:
+                    # probe with a single chunk to learn how fast this machine scores
+                    size = 1
+                else:
+                    size = min(batch_size, int(remaining / self.seconds_per_pair))
+                if remaining <= 0 or size < 1:
+                    print(
+                        f"Reranking would exceed its {budget_ms}ms budget after {len(scores)}/"
+                        f"{len(texts)} chunks, keeping the retrieval order"
+                    )
+                    return nodes[:top_k]
+                batch = texts[len(scores) : len(scores) + size]
+                batch_start = time.time()
+                scores.extend(
+                    float(score)
+                    for score in self.model.predict(
+                        [(query_str, text) for text in batch], batch_size=len(batch)
+                    )
+                )
+                self._update_speed((time.time() - batch_start) / len(batch))
+
+        # cross-encoders return logits or probabilities depending on the model, so the order is
+        # turned into scores in (0, 1] like the fused retrieval scores the context packer expects
+        order = sorted(range(len(nodes)), key=lambda idx: scores[idx], reverse=True)
+        reranked = [
+            NodeWithScore(node=nodes[idx].node, score=1 - rank / len(nodes))
+            for rank, idx in enumerate(order[:top_k])
+        ]
+        print(f"Reranked {len(nodes)} chunks in {(time.time() - start_time) * 1000:.0f}ms")
+        return reranked
+
+    def _update_speed(self, seconds_per_pair: float):
+        # moving average, so that one slow batch does not make the next ones tiny
+        if self.seconds_per_pair is None:
+            self.seconds_per_pair = seconds_per_pair
+        else:
+            self.seconds_per_pair = 0.7 * self.seconds_per_pair + 0.3 * seconds_per_pair
+
+
+def get_reranker(model_name: str) -> Optional[Reranker]:
+    """Shared reranker per model name, None if sentence-transformers is not installed"""
+    global _warned_not_installed
+    if CrossEncoder is None:
+        if not _warned_not_installed:
+            print("sentence-transformers is not installed, reranking is disabled")
+            _warned_not_installed = True
+        return None
+
+    with _rerankers_lock:
+        if model_name not in _rerankers:
+            _rerankers[model_name] = Reranker(model_name)
+        return _rerankers[model_name]
+
+
+def preload_reranker(model_name: str):
+    """Load the reranker in the background, so the first query does not wait for it"""
+    if CrossEncoder is None or model_name in _rerankers:
+        return
+    Thread(target=get_reranker, args=(model_name,), daemon=True).start()
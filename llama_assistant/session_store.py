@@ -0,0 +1,110 @@
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+from llama_cpp import Llama, LlamaState
+
+from llama_assistant import config
+
+
+class SessionStore:
+    """
+    Snapshots of a model's KV state and chat history, one per model id and context length.
+
+    The KV state covers the system prompt and the conversation evaluated so far. Restoring it
+    after a restart lets llama.cpp reuse that prefix, so the first response streams without
+    re-evaluating the whole conversation.
+    """
+
+    def __init__(self, session_dir: Path):
+        self.session_dir = Path(session_dir)
+
+    def _get_paths(self, model_id: str, context_len: int):
+        name = f"{model_id.replace('/', '__')}-{context_len}"
+        return self.session_dir / f"{name}.state", self.session_dir / f"{name}.json"
+
+    @staticmethod
+    def _get_model_signature(llm: Llama) -> Dict:
+        stat = os.stat(llm.model_path)
+        return {"model_path": llm.model_path, "size": stat.st_size, "mtime": stat.st_mtime}
+
+    @staticmethod
+    def snapshot(llm: Llama) -> LlamaState:
+        """Copy the model state without its logits buffer, which takes n_batch x n_vocab floats.
+        The logits are only read for logprobs, and generating always re-evaluates the last
+        prompt token."""
+        state = llm.save_state()
+        state.scores = np.zeros((0, llm.n_vocab()), dtype=np.single)
+        return state
+
+    def save(
+        self,
+        model_id: str,
+        context_len: int,
+        llm: Llama,
+        state: LlamaState,
+        chat_history: List[Dict],
+    ):
+        """Write a state taken with snapshot and the chat history it belongs to"""
+        state_path, _ = self._get_paths(model_id, context_len)
+        self.session_dir.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = state_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, state_path)
+
+        self.save_chat_history(model_id, context_len, llm, chat_history)
+
+    def save_chat_history(
+        self, model_id: str, context_len: int, llm: Llama, chat_history: List[Dict]
+    ):
+        """Only update the chat history, e.g. after clearing it. The KV state is kept since its
+        system prompt prefix is still useful."""
+        _, history_path = self._get_paths(model_id, context_len)
+        self.session_dir.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = history_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"model": self._get_model_signature(llm), "chat_history": chat_history},
+                f,
+            )
+        os.replace(tmp_path, history_path)
+
+    def restore(self, model_id: str, context_len: int, llm: Llama) -> Optional[List[Dict]]:
+        """Load the saved KV state into the model and return the saved chat history"""
+        state_path, history_path = self._get_paths(model_id, context_len)
+        if not state_path.exists() or not history_path.exists():
+            return None
+
+        try:
+            with open(history_path, "r") as f:
+                session_data = json.load(f)
+            if session_data["model"] != self._get_model_signature(llm):
+                print(f"Model file changed, discarding saved session of {model_id}")
+                self.remove(model_id, context_len)
+                return None
+
+            with open(state_path, "rb") as f:
+                state = pickle.load(f)
+            # the logits buffer is not saved, see snapshot
+            state.scores = np.zeros(llm.scores[: state.n_tokens].shape, dtype=np.single)
+            llm.load_state(state)
+        except Exception as e:
+            print(f"Failed to restore session of {model_id}: {e}")
+            self.remove(model_id, context_len)
+            return None
+
+        print(f"Restored session of {model_id} ({state.n_tokens} tokens)")
+        return session_data["chat_history"]
+
+    def remove(self, model_id: str, context_len: int):
+        for path in self._get_paths(model_id, context_len):
+            path.unlink(missing_ok=True)
+
+
+session_store = SessionStore(config.session_dir)
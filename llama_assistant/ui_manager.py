@@ -254,7 +254,7 @@ class UIManager:
         main_layout.addWidget(self.scroll_area)
 
         self.parent.esc_shortcut = QShortcut(QKeySequence("Esc"), self.parent)
-        self.parent.esc_shortcut.activated.connect(self.parent.hide)
+        self.parent.esc_shortcut.activated.connect(self.parent.on_escape)
 
         # Add an expanding spacer
         spacer = QSpacerItem(20, 40, QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Expanding)
@@ -0,0 +1,252 @@
+import math
+import time
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+# below this many nodes an exact search is fast enough and the IVF index is not built
+ANN_MIN_NODES = 2000
+# share of the IVF lists searched per query, at least MIN_PROBES of them
+PROBE_FRACTION = 0.1
+MIN_PROBES = 4
+KMEANS_ITERATIONS = 10
+# the IVF index is retrained once the number of nodes changed by this factor
+RETRAIN_FACTOR = 2
+
+
+class LocalVectorStore(BasePydanticVectorStore):
+    """
+    In-memory vector store with exact search for small document sets and an inverted file
+    (IVF) index above ANN_MIN_NODES nodes.
+
+    The IVF index clusters the normalized embeddings with k-means into about sqrt(n) lists.
+    A query is only compared with the nodes of the lists whose centroids are closest to it,
+    which keeps retrieval fast when thousands of pages are attached.
+    """
+
+    stores_text: bool = False
+    ann_min_nodes: int = ANN_MIN_NODES
+
+    _lock: Lock = PrivateAttr()
+    _vectors: np.ndarray = PrivateAttr()
+    _node_ids: List[str] = PrivateAttr()
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr()
+    _rows: Dict[str, int] = PrivateAttr()
+    _centroids: Optional[np.ndarray] = PrivateAttr()
+    _assignments: np.ndarray = PrivateAttr()
+    _trained_size: int = PrivateAttr()
+
+    def __init__(self, ann_min_nodes: int = ANN_MIN_NODES, **kwargs: Any):
+        super().__init__(ann_min_nodes=ann_min_nodes, **kwargs)
+        self._lock = Lock()
+        self.clear()
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self._node_ids)
+
+    @property
+    def uses_ann(self) -> bool:
+        return self._centroids is not None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._vectors = np.zeros((0, 0), dtype=np.float32)
+            self._node_ids = []
+            self._ref_doc_ids = []
+            self._rows = {}
+            self._centroids = None
+            self._assignments = np.zeros(0, dtype=np.int32)
+            self._trained_size = 0
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        vectors = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            num_nodes = self.num_nodes
+            self._reserve(num_nodes + len(nodes), vectors.shape[1])
+            self._vectors[num_nodes : num_nodes + len(nodes)] = vectors
+            if self._centroids is not None:
+                self._assignments[num_nodes : num_nodes + len(nodes)] = np.argmax(
+                    vectors @ self._centroids.T, axis=1
+                )
+            for node in nodes:
+                self._rows[node.node_id] = len(self._node_ids)
+                self._node_ids.append(node.node_id)
+                self._ref_doc_ids.append(node.ref_doc_id)
+        return [node.node_id for node in nodes]
+
+    def _reserve(self, size: int, dim: int):
+        """Grow the matrix geometrically so that incremental adds stay cheap"""
+        if self._vectors.shape[0] >= size:
+            return
+        capacity = max(size, 2 * self._vectors.shape[0], 1024)
+        vectors = np.zeros((capacity, dim), dtype=np.float32)
+        assignments = np.zeros(capacity, dtype=np.int32)
+        # an empty store has no dimension yet, there is nothing to copy
+        if self.num_nodes:
+            vectors[: self.num_nodes] = self._vectors[: self.num_nodes]
+            assignments[: self.num_nodes] = self._assignments[: self.num_nodes]
+        self._vectors = vectors
+        self._assignments = assignments
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            node_ids = [
+                node_id
+                for node_id, doc_id in zip(self._node_ids, self._ref_doc_ids)
+                if doc_id == ref_doc_id
+            ]
+            self._delete_node_ids(node_ids)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        with self._lock:
+            self._delete_node_ids(node_ids or [])
+
+    def _delete_node_ids(self, node_ids: List[str]):
+        for node_id in node_ids:
+            row = self._rows.pop(node_id, None)
+            if row is None:
+                continue
+            # move the last row into the free one
+            last = len(self._node_ids) - 1
+            if row != last:
+                moved_id = self._node_ids[last]
+                self._vectors[row] = self._vectors[last]
+                self._assignments[row] = self._assignments[last]
+                self._node_ids[row] = moved_id
+                self._ref_doc_ids[row] = self._ref_doc_ids[last]
+                self._rows[moved_id] = row
+            self._node_ids.pop()
+            self._ref_doc_ids.pop()
+
+    def build(self) -> None:
+        """Train or drop the IVF index after the nodes have changed"""
+        with self._lock:
+            num_nodes = self.num_nodes
+            if num_nodes < self.ann_min_nodes:
+                self._centroids = None
+                return
+            if (
+                self._centroids is not None
+                and self._trained_size / RETRAIN_FACTOR <= num_nodes
+                and num_nodes <= self._trained_size * RETRAIN_FACTOR
+            ):
+                return
+
+            start_time = time.time()
+            self._train(self._vectors[:num_nodes])
+        print(
+            f"Built IVF index with {len(self._centroids)} lists over {num_nodes} nodes "
+            f"in {time.time() - start_time:.2f}s"
+        )
+        benchmark = self.benchmark()
+        print(
+            f"IVF recall@10: {benchmark['recall']:.3f}, "
+            f"{benchmark['ann_ms']:.2f}ms vs {benchmark['exact_ms']:.2f}ms for exact search"
+        )
+
+    def _train(self, vectors: np.ndarray):
+        """Spherical k-means"""
+        num_lists = max(1, int(math.sqrt(len(vectors))))
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            counts = np.bincount(assignments, minlength=num_lists)
+            # restart empty lists from random nodes
+            empty = counts == 0
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        self._centroids = centroids
+        self._assignments[: len(vectors)] = np.argmax(vectors @ centroids.T, axis=1)
+        self._trained_size = len(vectors)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        query_vector = np.asarray(query.query_embedding, dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+        with self._lock:
+            if self.num_nodes == 0:
+                return VectorStoreQueryResult(ids=[], similarities=[])
+            if self._centroids is not None:
+                rows, similarities = self._search_ivf(query_vector, query.similarity_top_k)
+            else:
+                rows, similarities = self._search_exact(query_vector, query.similarity_top_k)
+            node_ids = [self._node_ids[row] for row in rows]
+        return VectorStoreQueryResult(ids=node_ids, similarities=similarities.tolist())
+
+    def _search_exact(self, query_vector: np.ndarray, top_k: int):
+        similarities = self._vectors[: self.num_nodes] @ query_vector
+        return self._top_k(np.arange(self.num_nodes), similarities, top_k)
+
+    def _search_ivf(self, query_vector: np.ndarray, top_k: int):
+        num_lists = len(self._centroids)
+        num_probes = min(num_lists, max(MIN_PROBES, math.ceil(num_lists * PROBE_FRACTION)))
+        centroid_scores = self._centroids @ query_vector
+        probes = np.argpartition(-centroid_scores, num_probes - 1)[:num_probes]
+        rows = np.nonzero(np.isin(self._assignments[: self.num_nodes], probes))[0]
+        similarities = self._vectors[rows] @ query_vector
+        return self._top_k(rows, similarities, top_k)
+
+    @staticmethod
+    def _top_k(rows: np.ndarray, similarities: np.ndarray, top_k: int):
+        if len(rows) > top_k:
+            best = np.argpartition(-similarities, top_k - 1)[:top_k]
+            rows, similarities = rows[best], similarities[best]
+        order = np.argsort(-similarities)
+        return rows[order], similarities[order]
+
+    def benchmark(self, num_queries: int = 20, top_k: int = 10) -> Dict[str, float]:
+        """Recall and mean latency of the IVF search against the exact search, using perturbed
+        stored embeddings as queries"""
+        with self._lock:
+            if self._centroids is None or self.num_nodes == 0:
+                return {"recall": 1.0, "ann_ms": 0.0, "exact_ms": 0.0}
+
+            rng = np.random.default_rng(0)
+            rows = rng.choice(self.num_nodes, min(num_queries, self.num_nodes), replace=False)
+            queries = self._vectors[rows] + rng.normal(
+                scale=0.05, size=(len(rows), self._vectors.shape[1])
+            ).astype(np.float32)
+            queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+            hits = 0
+            ann_time = exact_time = 0.0
+            for query_vector in queries:
+                start_time = time.perf_counter()
+                exact_rows, _ = self._search_exact(query_vector, top_k)
+                exact_time += time.perf_counter() - start_time
+                start_time = time.perf_counter()
+                ann_rows, _ = self._search_ivf(query_vector, top_k)
+                ann_time += time.perf_counter() - start_time
+                hits += len(set(exact_rows.tolist()) & set(ann_rows.tolist()))
+
+        return {
+            "recall": hits / (len(queries) * min(top_k, self.num_nodes)),
+            "ann_ms": ann_time / len(queries) * 1000,
+            "exact_ms": exact_time / len(queries) * 1000,
+        }
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Regression test: a request submitted right after a cancelled streaming response on the same
+model must not hang on the model lock.
+"""
+
+import time
+from threading import Event, Thread
+
+import pytest
+
+pytest.importorskip("llama_cpp")
+pytest.importorskip("llama_index.embeddings.huggingface")
+
+from llama_assistant import config
+from llama_assistant.agent import RAGAgent
+from llama_assistant.event_loop_runner import EventLoopRunner
+from llama_assistant.model_handler import ModelHandler
+
+
+class SlowLlama:
+    """Stands in for llama_cpp.Llama, decoding one word every token_time seconds"""
+
+    n_tokens = 0
+
+    def __init__(self, token_time: float):
+        self.token_time = token_time
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        return text.split()
+
+    def create_chat_completion(self, messages, stream=False, stopping_criteria=None, **kwargs):
+        words = ["word"] * 20
+        if not stream:
+            time.sleep(self.token_time * len(words))
+            return {"choices": [{"message": {"role": "assistant", "content": " ".join(words)}}]}
+        return self._stream(words, stopping_criteria)
+
+    def _stream(self, words, stopping_criteria):
+        yield {"choices": [{"delta": {"role": "assistant"}}]}
+        for word in words:
+            time.sleep(self.token_time)
+            if stopping_criteria is not None and stopping_criteria(None, None):
+                return
+            yield {"choices": [{"delta": {"content": word + " "}}]}
+
+
+class FakeThread:
+    def set_preloading(self, preloading: bool, message: str):
+        pass
+
+
+def stream(runner, agent, cancel_event):
+    return runner.iterate(
+        ModelHandler().stream_agent(agent, "hello", set(), None, cancel_event, FakeThread())
+    )
+
+
+@pytest.mark.parametrize("token_time", [0.3, 0.05, 0.01])
+def test_resubmit_after_cancel(token_time):
+    agent = RAGAgent(
+        config.DEFAULT_SETTINGS["generation"],
+        config.DEFAULT_SETTINGS["rag"],
+        llm=SlowLlama(token_time),
+    )
+    runner = EventLoopRunner("test-agent-loop")
+    try:
+        # cancel the first response after a few tokens, as the processing thread does
+        cancel_event = Event()
+        output = stream(runner, agent, cancel_event)
+        for idx, _ in enumerate(output):
+            if idx == 3:
+                break
+        cancel_event.set()
+        output.close()
+
+        chunks = []
+        second = Thread(target=lambda: chunks.extend(stream(runner, agent, Event())), daemon=True)
+        second.start()
+        second.join(timeout=30)
+        assert not second.is_alive(), "the request after the cancelled one hangs"
+        assert sum("content" in chunk["choices"][0]["delta"] for chunk in chunks) == 20
+    finally:
+        runner.stop()
+
+
+if __name__ == "__main__":
+    for token_time in (0.3, 0.05, 0.01):
+        test_resubmit_after_cancel(token_time)
+    print("✓ A new request runs after a cancelled one")
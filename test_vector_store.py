@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Smoke test of the local vector store: insert, delete and query, with exact and IVF search.
+"""
+
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from llama_assistant.vector_store import LocalVectorStore
+
+
+def make_nodes(count, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        TextNode(id_=f"node-{idx}", text=f"chunk {idx}", embedding=rng.normal(size=dim).tolist())
+        for idx in range(count)
+    ]
+
+
+def query_ids(store, embedding, top_k=5):
+    result = store.query(VectorStoreQuery(query_embedding=embedding, similarity_top_k=top_k))
+    return result.ids
+
+
+def test_empty_store():
+    store = LocalVectorStore()
+    assert query_ids(store, [1.0] * 16) == []
+
+
+def test_insert_delete_query():
+    store = LocalVectorStore()
+    nodes = make_nodes(50)
+    store.add(nodes[:10])
+    store.add(nodes[10:])
+    store.build()
+    assert not store.uses_ann
+    assert query_ids(store, nodes[7].embedding)[0] == "node-7"
+
+    store.delete_nodes(["node-7", "node-0"])
+    assert store.num_nodes == 48
+    assert "node-7" not in query_ids(store, nodes[7].embedding)
+    # the last row was moved into the deleted ones
+    assert query_ids(store, nodes[49].embedding)[0] == "node-49"
+
+
+def test_ivf_search():
+    store = LocalVectorStore(ann_min_nodes=200)
+    nodes = make_nodes(500)
+    store.add(nodes)
+    store.build()
+    assert store.uses_ann
+    assert query_ids(store, nodes[123].embedding)[0] == "node-123"
+    assert store.benchmark()["recall"] > 0.5
+
+
+def main():
+    test_empty_store()
+    test_insert_delete_query()
+    test_ivf_search()
+    print("✓ Vector store insert, delete and query work")
+
+
+if __name__ == "__main__":
+    main()